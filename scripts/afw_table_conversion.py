@@ -0,0 +1,92 @@
+"""
+afw_table_conversion.py
+
+Column-projected conversion of AFW catalogs to NumPy, Pandas, and Arrow.
+
+`cat.asAstropy().to_pandas()` copies every column of an AFW catalog twice
+(AFW -> AstroPy -> Pandas), even when only a small subset of the columns is
+needed downstream. The functions here copy only the requested columns out of
+the AFW record buffers (via the catalog's column view) straight into NumPy
+arrays, from which Pandas DataFrames or Arrow tables are built without
+additional copies.
+
+The requested columns are typically the `required_native_quantities` of one of
+the Dummy*Catalog classes, plus whatever extra fields (e.g., fluxes for
+calibration) the caller needs. Requested names that are not in the AFW schema
+(e.g., columns that are computed later) are simply ignored.
+"""
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+__all__ = ["afw_column_names", "afw_to_arrays", "afw_to_pandas", "afw_to_arrow"]
+
+
+def afw_column_names(cat):
+    """Return the field names of an AFW catalog, in schema order."""
+    return [item.field.getName() for item in cat.schema]
+
+
+def _select_names(cat, columns):
+    names = afw_column_names(cat)
+    if columns is None:
+        return names
+    columns = set(columns)
+    return [name for name in names if name in columns]
+
+
+def afw_to_arrays(cat, columns=None, rows=None):
+    """Copy the requested columns of an AFW catalog into NumPy arrays.
+
+    Parameters
+    --
+    cat: AFW catalog (e.g., SourceCatalog)
+    columns: iterable of str, optional
+        Names of the fields to copy.  Names not in the schema are ignored.
+        If None, copy all fields.
+    rows: boolean or integer array, optional
+        If given, only copy these rows (e.g., an isPrimary mask).
+
+    Returns
+    --
+    OrderedDict of {name: np.ndarray}, in schema order.
+    Flag fields are returned as bool arrays and Angle fields in radians,
+    the same as `cat.asAstropy()`.
+    """
+    names = _select_names(cat, columns)
+    if not cat.isContiguous():
+        cat = cat.copy(deep=True)
+    column_view = cat.columns
+
+    arrays = OrderedDict()
+    for name in names:
+        try:
+            arr = column_view[name]
+        except Exception:  # pylint: disable=broad-except
+            # Fields without a column view (e.g., strings) are read record by record
+            key = cat.schema.find(name).key
+            arr = np.array([record.get(key) for record in cat])
+        # Both copy a strided view into the record buffer into a compact array
+        arrays[name] = np.array(arr) if rows is None else np.asarray(arr)[rows]
+    return arrays
+
+
+def afw_to_pandas(cat, columns=None, rows=None):
+    """Convert the requested columns of an AFW catalog to a Pandas DataFrame.
+
+    See `afw_to_arrays` for the parameters.
+    """
+    arrays = afw_to_arrays(cat, columns=columns, rows=rows)
+    n_rows = len(cat) if rows is None else len(np.arange(len(cat))[rows])
+    return pd.DataFrame(arrays, index=pd.RangeIndex(n_rows), columns=list(arrays))
+
+
+def afw_to_arrow(cat, columns=None, rows=None):
+    """Convert the requested columns of an AFW catalog to an Arrow Table.
+
+    See `afw_to_arrays` for the parameters.
+    """
+    arrays = afw_to_arrays(cat, columns=columns, rows=rows)
+    return pa.Table.from_arrays([pa.array(arr) for arr in arrays.values()], names=list(arrays))
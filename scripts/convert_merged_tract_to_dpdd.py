@@ -29,6 +29,8 @@ import pandas as pd
 import GCRCatalogs
 from GCRCatalogs.dc2_object import FILE_PATTERN
 
+from patch_encoding import decode_patch_str
+
 
 def convert_cat_to_dpdd(reader='dc2_object_run1.1p',
                         reader_config_overwrite=None, **kwargs):
@@ -106,6 +108,8 @@ def write_dataframe_to_files(
     # So we take the tract and patch in the first entry
     # as the identifying tract, patch for all.
     tract, patch = df['tract'][0], df['patch'][0]
+    if not isinstance(patch, str):
+        patch = decode_patch_str(patch)
     patch = patch.replace(',', '')  # Convert '0,1'->'01'
 
     # Normalize output filename
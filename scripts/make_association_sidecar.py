@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+
+"""
+Write per-tract association sidecar files of an Object Table,
+for associating sources to objects (see `merge_source_cat.py`)
+without loading the full Object Table or reading the coadd reference catalogs.
+
+Each tract is stored in its own directory <output_dir>/<tract>/ with
+    id.npy    : object ids (int64)
+    xyz.npy   : unit vectors of the object positions (float64, shape (n, 3))
+    key.npy   : sorted zone key, zone * 1000 + ra [deg] (float64),
+                where zone = floor((dec + 90) / zone_height) - zone_min
+    meta.json : tract, number of objects, zone height and min, and RA/Dec bounds
+All arrays are in the order of the sorted key, which serves as the spatial index
+(declination zones, sorted by RA within each zone).
+The .npy files are memory-mapped when read, so that all processes on a node
+share the same pages of the tracts they need.
+"""
+import os
+import glob
+import json
+import time
+import fcntl
+import shutil
+import socket
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+import numpy as np
+
+import GCRCatalogs
+
+from sky_coordinates import radec_deg_to_xyz
+
+__all__ = [
+    "write_association_sidecar", "AssociationSidecar", "AssociationSidecarSet", "attach_object_table_bundle",
+]
+
+_ZONE_KEY_STRIDE = 1000.0
+
+
+def _get_zone(dec, zone_height):
+    return np.floor((np.asarray(dec, dtype=np.float64) + 90.0) / zone_height).astype(np.int64)
+
+
+def write_association_sidecar(output_dir, ids, ra, dec, tract=None, zone_height_arcsec=2.0):
+    """Write association sidecar files for one tract.
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory to store the sidecar files (usually <sidecar_root>/<tract>)
+    ids : array_like
+        Object ids
+    ra, dec : array_like
+        Object positions in degrees
+    tract : int, optional
+        Tract number, stored in the metadata
+    zone_height_arcsec : float, optional (default: 2.0)
+        Height of the declination zones
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    ra = np.mod(np.asarray(ra, dtype=np.float64), 360.0)
+    dec = np.asarray(dec, dtype=np.float64)
+    zone_height = zone_height_arcsec / 3600.0
+
+    zone = _get_zone(dec, zone_height)
+    zone_min = int(zone.min()) if len(zone) else 0
+    key = (zone - zone_min) * _ZONE_KEY_STRIDE + ra
+    order = np.argsort(key, kind="stable")
+
+    os.makedirs(output_dir, exist_ok=True)
+    np.save(os.path.join(output_dir, "id.npy"), ids[order])
+    np.save(os.path.join(output_dir, "xyz.npy"), radec_deg_to_xyz(ra[order], dec[order]))
+    np.save(os.path.join(output_dir, "key.npy"), key[order])
+
+    meta = {
+        "tract": None if tract is None else int(tract),
+        "n": int(len(ids)),
+        "zone_height_arcsec": float(zone_height_arcsec),
+        "zone_min": zone_min,
+        "ra_min": float(ra.min()) if len(ra) else None,
+        "ra_max": float(ra.max()) if len(ra) else None,
+        "dec_min": float(dec.min()) if len(dec) else None,
+        "dec_max": float(dec.max()) if len(dec) else None,
+    }
+    with open(os.path.join(output_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+
+class AssociationSidecar():
+    """Memory-mapped association sidecar of one tract.
+
+    Parameters
+    ----------
+    path : str
+        Directory that contains the sidecar files of one tract
+    """
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.ids = np.load(os.path.join(path, "id.npy"), mmap_mode="r")
+        self.xyz = np.load(os.path.join(path, "xyz.npy"), mmap_mode="r")
+        self.key = np.load(os.path.join(path, "key.npy"), mmap_mode="r")
+        self.zone_height = self.meta["zone_height_arcsec"] / 3600.0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def overlaps(self, ra_min, ra_max, dec_min, dec_max, margin=0):
+        """Check if the tract overlaps the given RA, Dec [deg] range, extended by margin [deg].
+
+        RA ranges are compared modulo 360, so that a range near RA = 0 overlaps a tract near RA = 360.
+        """
+        if not len(self):
+            return False
+        cos_dec = np.cos(np.deg2rad(min(max(abs(dec_min), abs(dec_max)) + margin, 90.0)))
+        ra_margin = 180.0 if cos_dec <= margin / 180.0 else margin / cos_dec
+        if not (dec_min - margin <= self.meta["dec_max"] and dec_max + margin >= self.meta["dec_min"]):
+            return False
+        return any(
+            ra_min - ra_margin <= self.meta["ra_max"] + shift and ra_max + ra_margin >= self.meta["ra_min"] + shift
+            for shift in (-360.0, 0.0, 360.0)
+        )
+
+    def query(self, ra, dec, matching_radius=1):
+        """Find the closest object within matching_radius [arcsec] for each position.
+
+        ra, dec are in degrees.
+
+        Returns
+        -------
+        ids : ndarray of int64
+            Associated object ids; -1 for no match
+        sep : ndarray of float64
+            Separations in arcsec; inf for no match
+        """
+        ra = np.mod(np.asarray(ra, dtype=np.float64), 360.0)
+        dec = np.asarray(dec, dtype=np.float64)
+        n = len(ra)
+        radius = float(matching_radius) / 3600.0
+        max_chord2 = (2 * np.sin(np.deg2rad(radius) / 2)) ** 2
+
+        # Half-width of the search window in RA
+        cos_dec = np.cos(np.deg2rad(np.minimum(np.abs(dec) + radius, 90.0)))
+        with np.errstate(divide="ignore"):
+            delta_ra = np.where(cos_dec > radius / 180.0, radius / cos_dec, 180.0)
+
+        xyz_src = radec_deg_to_xyz(ra, dec)
+        zone = _get_zone(dec, self.zone_height) - self.meta["zone_min"]
+        n_zones = int(self.key[-1] // _ZONE_KEY_STRIDE) + 1 if len(self) else 0
+        n_zones_to_search = int(np.ceil(radius / self.zone_height))
+
+        pair_src, pair_obj = [], []
+        for dz in range(-n_zones_to_search, n_zones_to_search + 1):
+            zone_this = zone + dz
+            zone_ok = (zone_this >= 0) & (zone_this < n_zones)
+            for shift in (-360.0, 0.0, 360.0):
+                lo_ra = np.clip(ra - delta_ra + shift, 0.0, 360.0)
+                hi_ra = np.clip(ra + delta_ra + shift, 0.0, 360.0)
+                ok = zone_ok & (hi_ra > lo_ra)
+                lo = np.searchsorted(self.key, zone_this * _ZONE_KEY_STRIDE + lo_ra, side="left")
+                hi = np.searchsorted(self.key, zone_this * _ZONE_KEY_STRIDE + hi_ra, side="right")
+                counts = np.where(ok, hi - lo, 0)
+                total = counts.sum()
+                if not total:
+                    continue
+                src = np.repeat(np.arange(n), counts)
+                pair_obj.append(np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts))
+                pair_src.append(src)
+
+        ids = np.full(n, -1, dtype=np.int64)
+        sep = np.full(n, np.inf)
+        if not pair_src:
+            return ids, sep
+
+        pair_src = np.concatenate(pair_src)
+        pair_obj = np.concatenate(pair_obj)
+        chord2 = np.sum((xyz_src[pair_src] - self.xyz[pair_obj]) ** 2, axis=1)
+        within = chord2 <= max_chord2
+        pair_src, pair_obj, chord2 = pair_src[within], pair_obj[within], chord2[within]
+
+        # Keep the closest object for each source
+        order = np.lexsort((chord2, pair_src))
+        pair_src, pair_obj, chord2 = pair_src[order], pair_obj[order], chord2[order]
+        first = np.ones(len(pair_src), dtype=bool)
+        first[1:] = pair_src[1:] != pair_src[:-1]
+        ids[pair_src[first]] = self.ids[pair_obj[first]]
+        sep[pair_src[first]] = np.rad2deg(2 * np.arcsin(np.sqrt(chord2[first]) / 2)) * 3600.0
+        return ids, sep
+
+
+class AssociationSidecarSet():
+    """All association sidecars under a root directory (one subdirectory per tract).
+
+    Only the metadata are read when opening; the arrays of a tract
+    are memory-mapped the first time a query touches that tract.
+
+    Parameters
+    ----------
+    root_dir : str
+        Root directory of the sidecar files, i.e., <root_dir>/<tract>/
+    """
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.meta = dict()
+        for name in sorted(os.listdir(root_dir)):
+            meta_path = os.path.join(root_dir, name, "meta.json")
+            if os.path.isfile(meta_path):
+                with open(meta_path) as f:
+                    self.meta[name] = json.load(f)
+        self._sidecars = dict()
+
+    def __len__(self):
+        return sum(meta["n"] for meta in self.meta.values())
+
+    def _get_sidecar(self, name):
+        if name not in self._sidecars:
+            self._sidecars[name] = AssociationSidecar(os.path.join(self.root_dir, name))
+        return self._sidecars[name]
+
+    def query(self, ra, dec, matching_radius=1):
+        """Return the ID of the closest object within matching_radius [arcsec].
+
+        ra, dec are in radians (to match `ObjectTableIndex.query`).
+        Entries with no match will be -1.
+        """
+        ra = np.rad2deg(np.asarray(ra, dtype=np.float64))
+        dec = np.rad2deg(np.asarray(dec, dtype=np.float64))
+        ids = np.full(len(ra), -1, dtype=np.int64)
+        if not len(ra):
+            return ids
+
+        sep = np.full(len(ra), np.inf)
+        margin = float(matching_radius) / 3600.0
+        ra_wrapped = np.mod(ra, 360.0)
+        bounds = (ra_wrapped.min(), ra_wrapped.max(), dec.min(), dec.max())
+        for name, meta in self.meta.items():
+            if not meta["n"]:
+                continue
+            sidecar = self._get_sidecar(name)
+            if not sidecar.overlaps(*bounds, margin=margin):
+                continue
+            ids_this, sep_this = sidecar.query(ra, dec, matching_radius)
+            closer = sep_this < sep
+            ids[closer] = ids_this[closer]
+            sep[closer] = sep_this[closer]
+
+        return ids
+
+
+def _load_object_catalog(reader, base_dir=None):
+    config_overwrite = {}
+    if base_dir:
+        config_overwrite['base_dir'] = base_dir
+    cat = GCRCatalogs.load_catalog(reader, config_overwrite=config_overwrite)
+    id_col = 'diaObjectId' if 'dia_object' in reader else 'objectId'
+    return cat, id_col
+
+
+def _write_object_table_bundle(bundle_dir, reader, base_dir, timeout, my_print):
+    """Write the Object Table bundle, unless another process holding the lock already did.
+
+    The lock is an flock on <bundle_dir>.lock, which the kernel releases when the holder exits,
+    even if it is killed, so that a dead writer cannot block the other processes.
+    The lock file records the host and PID of the current writer for diagnostics.
+    """
+    lock_path = bundle_dir + ".lock"
+    tmp_dir = "{}.tmp{}".format(bundle_dir, os.getpid())
+    fd = os.open(lock_path, os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        t_start = time.time()
+        waiting = False
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.time() - t_start > timeout:
+                    raise RuntimeError("Timed out waiting for {}".format(bundle_dir))
+                if not waiting:
+                    my_print("Waiting for another process to write", bundle_dir)
+                    waiting = True
+                time.sleep(5)
+
+        # Another process may have completed the bundle while we were acquiring the lock
+        if os.path.isdir(bundle_dir):
+            return
+
+        # Only the lock holder writes a bundle, so any other temporary bundle was left by a killed writer
+        for stale_tmp_dir in glob.glob(glob.escape(bundle_dir) + ".tmp*"):
+            shutil.rmtree(stale_tmp_dir, ignore_errors=True)
+
+        os.ftruncate(fd, 0)
+        os.write(fd, "{} {}\n".format(socket.gethostname(), os.getpid()).encode())
+
+        if reader is None:
+            raise ValueError("{} does not exist and no reader is given to create it".format(bundle_dir))
+        my_print("Writing Object Table bundle", bundle_dir, "from", reader)
+        cat, id_col = _load_object_catalog(reader, base_dir)
+        data = cat.get_quantities([id_col, 'ra', 'dec'])
+        del cat
+        write_association_sidecar(os.path.join(tmp_dir, "all"), data[id_col], data['ra'], data['dec'])
+        del data
+        # Publish the bundle only when complete
+        os.rename(tmp_dir, bundle_dir)
+        # Safe while holding the lock: later lock holders find the bundle and return
+        os.unlink(lock_path)
+    finally:
+        # Do not leave a partial bundle behind in (node-local) memory
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.close(fd)
+
+
+def attach_object_table_bundle(bundle_dir, reader=None, base_dir=None, timeout=3600, silent=False):
+    """Attach to a read-only, memory-mapped Object Table bundle, creating it first if needed.
+
+    The bundle is an association sidecar of the full Object Table, stored in <bundle_dir>/all/.
+    Put `bundle_dir` on a node-local file system (e.g., /dev/shm) so that all processes
+    on a node share one copy of the Object Table id, ra, dec in memory.
+    When several processes start at once, the first one to take the lock writes the bundle
+    (from `reader`) and the others wait until it is complete.
+    If the writer fails or is killed, the next waiter takes the lock and writes the bundle.
+
+    Parameters
+    ----------
+    bundle_dir : str
+        Directory of the bundle.
+    reader : str, optional
+        GCR reader of the (DIA) Object Table. Required if the bundle does not exist yet.
+    base_dir : str, optional
+        Override the base_dir setting of the reader.
+    timeout : float, optional (default: 3600)
+        Maximal time [s] to wait for another process to write the bundle.
+    silent : bool, optional (default: False)
+        If true, turn off most printout.
+
+    Returns
+    -------
+    AssociationSidecarSet
+    """
+    my_print = (lambda *x: None) if silent else print
+
+    bundle_dir = os.path.normpath(bundle_dir)
+    if not os.path.isdir(bundle_dir):
+        _write_object_table_bundle(bundle_dir, reader, base_dir, timeout, my_print)
+
+    my_print("Attaching to Object Table bundle", bundle_dir)
+    return AssociationSidecarSet(bundle_dir)
+
+
+def make_association_sidecars(reader, output_dir, tracts=None, base_dir=None,
+                              zone_height_arcsec=2.0, silent=False, **kwargs):
+    """Write association sidecar files for each tract of an Object Table GCR catalog.
+
+    Parameters
+    ----------
+    reader : str
+        GCR reader of the (DIA) Object Table, e.g., dc2_object_run2.2i_dr6
+    output_dir : str
+        Root directory of the output. Each tract is written to <output_dir>/<tract>/
+
+    Optional Parameters
+    ----------------
+    tracts : list of int, optional
+        Tracts to process. Default to all available tracts of the reader.
+    base_dir : str, optional
+        Override the base_dir setting of the reader.
+    zone_height_arcsec : float, optional (default: 2.0)
+        Height of the declination zones of the spatial index.
+    silent : bool, optional (default: False)
+        If true, turn off most printout.
+    """
+    my_print = (lambda *x: None) if silent else print
+
+    cat, id_col = _load_object_catalog(reader, base_dir)
+
+    if not tracts:
+        tracts = sorted(cat.available_tracts)
+
+    for tract in tracts:
+        my_print("Writing association sidecar for tract", tract)
+        data = cat.get_quantities([id_col, 'ra', 'dec'], native_filters="tract == {}".format(tract))
+        write_association_sidecar(
+            os.path.join(output_dir, str(tract)),
+            data[id_col],
+            data['ra'],
+            data['dec'],
+            tract=tract,
+            zone_height_arcsec=zone_height_arcsec,
+        )
+        my_print("  Stored", len(data[id_col]), "objects")
+
+
+def main():
+    usage = """Write per-tract association sidecar files of an Object Table for `merge_source_cat.py`
+
+For example,
+
+  python %(prog)s dc2_object_run2.2i_dr6 -o $CSCRATCH/object_sidecar
+
+will create $CSCRATCH/object_sidecar/<tract>/ for every tract in the catalog.
+Then run `merge_source_cat.py` with `--object_sidecar_dir=$CSCRATCH/object_sidecar`.
+Each task will only memory-map the tracts that its visits touch.
+"""
+    parser = ArgumentParser(description=usage,
+                            formatter_class=RawTextHelpFormatter)
+    parser.add_argument("reader", help="GCR reader of the (DIA) Object Table")
+    parser.add_argument("-o", "--output-dir", default=".", help="Output root directory.")
+    parser.add_argument("--tracts", type=int, nargs="+", help="Tracts to process. Default to all tracts.")
+    parser.add_argument("--base-dir", help="Override the base_dir setting of the reader.")
+    parser.add_argument("--zone-height-arcsec", type=float, default=2.0,
+                        help="Height of the declination zones of the spatial index (default: %(default)s)")
+    parser.add_argument("--silent", action="store_true")
+
+    make_association_sidecars(**vars(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,6 @@ make_metacal_catalog.py
 Save catalogs to parquet from metacal runs across available patches.
 """
 import os
-import re
 
 import numpy as np
 from astropy.table import hstack
@@ -12,6 +11,10 @@ from astropy.table import hstack
 from lsst.daf.persistence import Butler
 from lsst.daf.persistence.butlerExceptions import NoResults
 
+from patch_encoding import encode_patch_str
+from parquet_write_options import write_dataframe, add_write_option_arguments, get_write_options_from_args
+from patch_scheduler import resolve_patches, run_patch_units
+
 
 def _ensure_butler_instance(butler_or_repo):
     if not isinstance(butler_or_repo, Butler):
@@ -23,6 +26,7 @@ def generate_metacal_catalog(output_dir, butler, tract, patches=None,
                              overwrite=True, verbose=False,
                              filename_prefix='metacal',
                              parquet_engine='pyarrow',
+                             write_options=None,
                              **kwargs):
     """Save catalogs to parquet from individual metacal patches.
     Iterates through patches, saving each in append mode to the save parquet file.
@@ -42,49 +46,62 @@ def generate_metacal_catalog(output_dir, butler, tract, patches=None,
         Overwrite existing output file(s).
     parquet_engine : str, optional
         default is pyarrow
+    write_options : dict, optional
+        Parquet writer options (compression, compression_level, dictionary, row_group_size),
+        see `parquet_write_options.write_dataframe`
     """
-    if not patches:
-        # Extract the patches for this tract from the skymap
-        butler = _ensure_butler_instance(butler)
-        skymap = butler.get(datasetType='deepCoadd_skyMap')
-        patches = ['%d,%d' % patch.getIndex() for patch in skymap[tract]]
-    elif hasattr(patches, 'split'):
-        patches = patches.split('^')
-
-    if not all(re.match(r'\d,\d$', p) for p in patches):
-        raise ValueError('patches should be a list or a string in "1,1^2,2^3,3" format')
+    butler = _ensure_butler_instance(butler)
+    patches = resolve_patches(butler, tract, patches)
 
     for patch in patches:
-        if verbose:
-            print("Processing tract %d, patch %s" % (tract, patch))
+        process_metacal_patch(output_dir, butler, tract, patch,
+                              overwrite=overwrite, verbose=verbose,
+                              filename_prefix=filename_prefix,
+                              parquet_engine=parquet_engine,
+                              write_options=write_options, **kwargs)
 
-        file_path = os.path.join(
-            output_dir,
-            '_'.join((filename_prefix, str(tract), patch.replace(',', ''))) + '.parquet',
-        )
 
-        if not overwrite and (os.path.exists(file_path) or os.path.exists(file_path + '.empty')):
-            if verbose:
-                print("  Skipping tract %d, patch %s because output file exist" % (tract, patch))
-            continue
+def process_metacal_patch(output_dir, butler, tract, patch,
+                          overwrite=True, verbose=False,
+                          filename_prefix='metacal',
+                          parquet_engine='pyarrow',
+                          write_options=None,
+                          **kwargs):
+    """Save the catalog of one patch to parquet.
+
+    See `generate_metacal_catalog` for the parameters.
+    `butler` must be a Butler instance.
+
+    Returns
+    --
+    status: str
+        "written", "empty" (no entries, an .empty file is written), or
+        "skipped" (output exists and `overwrite` is False)
+    """
+    if verbose:
+        print("Processing tract %d, patch %s" % (tract, patch))
 
-        butler = _ensure_butler_instance(butler)
+    file_path = os.path.join(
+        output_dir,
+        '_'.join((filename_prefix, str(tract), patch.replace(',', ''))) + '.parquet',
+    )
 
-        metacal_cat = load_metacal_patch(butler, tract, patch, verbose=verbose, **kwargs)
+    if not overwrite and (os.path.exists(file_path) or os.path.exists(file_path + '.empty')):
+        if verbose:
+            print("  Skipping tract %d, patch %s because output file exist" % (tract, patch))
+        return "skipped"
 
-        if metacal_cat is None:
-            if verbose:
-                print("  No entries for tract %d, patch %s" % (tract, patch))
-            open(file_path + '.empty', 'w').close()
-            continue
+    metacal_cat = load_metacal_patch(butler, tract, patch, verbose=verbose, **kwargs)
 
-        metacal_cat.to_parquet(
-            file_path,
-            engine=parquet_engine,
-            compression=None,
-            index=False,
-        )
-        del metacal_cat
+    if metacal_cat is None:
+        if verbose:
+            print("  No entries for tract %d, patch %s" % (tract, patch))
+        open(file_path + '.empty', 'w').close()
+        return "empty"
+
+    write_dataframe(metacal_cat, file_path, parquet_engine=parquet_engine, **(write_options or {}))
+    del metacal_cat
+    return "written"
 
 def load_metacal_patch(butler, tract, patch, verbose=False, return_pandas=True,
                        fields_to_join=('id',), debug=False):
@@ -145,7 +162,7 @@ def load_metacal_patch(butler, tract, patch, verbose=False, return_pandas=True,
 
     # Store tract and patch info
     metacal['tract'] = int(tract)
-    metacal['patch'] = str(patch)
+    metacal['patch'] = encode_patch_str(patch)
     
     return metacal.to_pandas() if return_pandas else metacal
 
@@ -178,14 +195,29 @@ Skymap patch[es] within each tract to process. Format should be "1,1^2,1^3,1"
     parser.add_argument('--parquet_engine', dest='engine', default='pyarrow',
                         choices=['fastparquet', 'pyarrow'],
                         help="""(default: %(default)s)""")
+    add_write_option_arguments(parser)
+    parser.add_argument('--n-workers', type=int, default=1,
+                        help='Number of processes to process (tract, patch) units in parallel. (default: %(default)s)')
     args = parser.parse_args()
 
     if len(args.tract) > 1 and args.patches:
         print("You specified more than 1 tract but only need partial patches??")
 
-    for tract in args.tract:
-        generate_metacal_catalog(
-            args.output_dir, args.repo, tract, args.patches,
-            overwrite=args.overwrite, verbose=args.verbose,
-            filename_prefix=args.name, parquet_engine=args.engine,
+    if args.n_workers > 1:
+        butler = Butler(args.repo)
+        units = [(tract, patch) for tract in args.tract for patch in resolve_patches(butler, tract, args.patches)]
+        del butler
+        run_patch_units(
+            process_metacal_patch, args.output_dir, args.repo, units,
+            n_workers=args.n_workers, verbose=args.verbose,
+            overwrite=args.overwrite, filename_prefix=args.name, parquet_engine=args.engine,
+            write_options=get_write_options_from_args(args),
         )
+    else:
+        for tract in args.tract:
+            generate_metacal_catalog(
+                args.output_dir, args.repo, tract, args.patches,
+                overwrite=args.overwrite, verbose=args.verbose,
+                filename_prefix=args.name, parquet_engine=args.engine,
+                write_options=get_write_options_from_args(args),
+            )
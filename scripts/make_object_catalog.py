@@ -4,14 +4,30 @@ make_object_catalog.py
 Save catalogs to parquet from forced-photometry coadds across available filters.
 """
 import os
-import re
+import json
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from astropy.table import Table
 
 from lsst.daf.persistence import Butler
 from lsst.daf.persistence.butlerExceptions import NoResults
 
+from afw_table_conversion import afw_to_arrays, afw_to_arrow
+from patch_encoding import encode_patch_str
+from parquet_write_options import (
+    get_writer_kwargs, write_dataframe, write_arrow_table, add_write_option_arguments, get_write_options_from_args,
+)
+from patch_scheduler import resolve_patches, run_patch_units
+
+# ParquetWriter.add_key_value_metadata is only available in pyarrow >= 13
+_HAS_ADD_KEY_VALUE_METADATA = hasattr(pq.ParquetWriter, 'add_key_value_metadata')
+
 
 def _ensure_butler_instance(butler_or_repo):
     if not isinstance(butler_or_repo, Butler):
@@ -30,10 +46,50 @@ def _get_fill_value(name, dtype):
     return np.array(fill_value, dtype=np.dtype(dtype))
 
 
+class _FillTemplate(object):
+    """Fill-value columns for a filter that is missing in a patch.
+
+    The columns are built once for a filter (forced_src) Arrow schema,
+    and zero-copy slices are returned for each patch.
+    """
+    def __init__(self, schema):
+        self.schema = schema
+        self._table = None
+
+    def get(self, n_rows):
+        if self._table is None or self._table.num_rows < n_rows:
+            if self._table is not None:
+                n_rows_alloc = max(n_rows, 2 * self._table.num_rows)
+            else:
+                n_rows_alloc = n_rows
+            arrays = []
+            for field in self.schema:
+                dtype = np.dtype(str) if pa.types.is_string(field.type) else field.type.to_pandas_dtype()
+                fill_value = _get_fill_value(field.name, dtype)
+                arrays.append(pa.array(np.broadcast_to(fill_value, n_rows_alloc), type=field.type))
+            self._table = pa.Table.from_arrays(arrays, schema=self.schema)
+        return self._table.slice(0, n_rows)
+
+
+@lru_cache(maxsize=None)
+def _get_fill_template(filter_schema):
+    return _FillTemplate(filter_schema)
+
+
+@lru_cache(maxsize=None)
+def _get_merged_schema(ref_schema, filter_schema, filters):
+    fields = list(ref_schema)
+    for filter_this in filters:
+        fields.extend(field.with_name('{}_{}'.format(filter_this, field.name)) for field in filter_schema)
+    return pa.schema(fields)
+
+
 def generate_object_catalog(output_dir, butler, tract, patches=None,
                             overwrite=True, verbose=False,
                             filename_prefix='object',
                             parquet_engine='pyarrow',
+                            write_options=None,
+                            tract_file=False,
                             **kwargs):
     """Save catalogs to parquet from forced-photometry coadds across available filters.
     Iterates through patches, saving each in append mode to the save parquet file.
@@ -53,53 +109,180 @@ def generate_object_catalog(output_dir, butler, tract, patches=None,
         Overwrite existing output file(s).
     parquet_engine : str, optional
         default is pyarrow
+    write_options : dict, optional
+        Parquet writer options (compression, compression_level, dictionary, row_group_size),
+        see `parquet_write_options.write_dataframe`
+    tract_file : bool, optional
+        If True, write all patches into one file per tract,
+        "%s_tract_%d.parquet" % (filename_prefix, tract), with one row group per patch.
+        See `write_object_tract_file`.
     """
-    if not patches:
-        # Extract the patches for this tract from the skymap
-        butler = _ensure_butler_instance(butler)
-        skymap = butler.get(datasetType='deepCoadd_skyMap')
-        patches = ['%d,%d' % patch.getIndex() for patch in skymap[tract]]
-    elif hasattr(patches, 'split'):
-        patches = patches.split('^')
-
-    if not all(re.match(r'\d,\d$', p) for p in patches):
-        raise ValueError('patches should be a list or a string in "1,1^2,2^3,3" format')
+    butler = _ensure_butler_instance(butler)
+    patches = resolve_patches(butler, tract, patches)
+
+    if tract_file:
+        if parquet_engine != 'pyarrow':
+            raise ValueError("Must use pyarrow when tract_file is set to True")
+        write_object_tract_file(output_dir, butler, tract, patches,
+                                overwrite=overwrite, verbose=verbose,
+                                filename_prefix=filename_prefix,
+                                write_options=write_options, **kwargs)
+        return
 
     for patch in patches:
+        process_object_patch(output_dir, butler, tract, patch,
+                             overwrite=overwrite, verbose=verbose,
+                             filename_prefix=filename_prefix,
+                             parquet_engine=parquet_engine,
+                             write_options=write_options, **kwargs)
+
+
+def process_object_patch(output_dir, butler, tract, patch,
+                         overwrite=True, verbose=False,
+                         filename_prefix='object',
+                         parquet_engine='pyarrow',
+                         write_options=None,
+                         **kwargs):
+    """Save the catalog of one patch to parquet.
+
+    See `generate_object_catalog` for the parameters.
+    `butler` must be a Butler instance.
+
+    Returns
+    --
+    status: str
+        "written", "empty" (no entries, an .empty file is written), or
+        "skipped" (output exists and `overwrite` is False)
+    """
+    if verbose:
+        print("Processing tract %d, patch %s" % (tract, patch))
+
+    file_path = os.path.join(
+        output_dir,
+        '_'.join((filename_prefix, str(tract), patch.replace(',', ''))) + '.parquet',
+    )
+
+    if not overwrite and (os.path.exists(file_path) or os.path.exists(file_path + '.empty')):
         if verbose:
-            print("Processing tract %d, patch %s" % (tract, patch))
+            print("  Skipping tract %d, patch %s because output file exist" % (tract, patch))
+        return "skipped"
 
-        file_path = os.path.join(
-            output_dir,
-            '_'.join((filename_prefix, str(tract), patch.replace(',', ''))) + '.parquet',
-        )
+    merged_cat = merge_coadd_forced_src(butler, tract, patch, verbose=verbose,
+                                        return_arrow=(parquet_engine == 'pyarrow'), **kwargs)
+
+    if merged_cat is None:
+        if verbose:
+            print("  No entries for tract %d, patch %s" % (tract, patch))
+        open(file_path + '.empty', 'w').close()
+        return "empty"
+
+    if parquet_engine == 'pyarrow':
+        write_arrow_table(merged_cat, file_path, **(write_options or {}))
+    else:
+        write_dataframe(merged_cat, file_path, parquet_engine=parquet_engine, **(write_options or {}))
+    del merged_cat
+    return "written"
 
-        if not overwrite and (os.path.exists(file_path) or os.path.exists(file_path + '.empty')):
-            if verbose:
-                print("  Skipping tract %d, patch %s because output file exist" % (tract, patch))
-            continue
 
-        butler = _ensure_butler_instance(butler)
-        merged_cat = merge_coadd_forced_src(butler, tract, patch, verbose=verbose, **kwargs)
+def _get_patch_stats(patch, row_group, table):
+    stats = {'patch': patch, 'row_group': row_group, 'num_rows': table.num_rows}
+    for name in ('coord_ra', 'coord_dec'):
+        if name in table.column_names:
+            min_max = pc.min_max(table[name])
+            stats[name] = [min_max['min'].as_py(), min_max['max'].as_py()]
+    return stats
 
-        if merged_cat is None:
+
+def write_object_tract_file(output_dir, butler, tract, patches,
+                            overwrite=True, verbose=False,
+                            filename_prefix='object',
+                            write_options=None,
+                            **kwargs):
+    """Save the catalogs of all patches of a tract into one parquet file.
+
+    Each patch is appended as its own row group by a single ParquetWriter,
+    so no separate merge pass is needed, and readers can still select patches
+    by row-group statistics of the `patch` column.
+    The patch, row group, number of rows, and coord_ra/coord_dec ranges [rad]
+    of each patch are stored as JSON in the "patches" key of the file metadata,
+    or, with pyarrow versions that cannot add metadata after writing (< 13),
+    in a <file>.patches.json sidecar file.
+
+    See `generate_object_catalog` for the parameters.
+    `butler` must be a Butler instance.
+
+    Returns
+    --
+    status: str
+        "written", "empty" (no entries, an .empty file is written), or
+        "skipped" (output exists and `overwrite` is False)
+    """
+    file_path = os.path.join(output_dir, '{}_tract_{}.parquet'.format(filename_prefix, tract))
+
+    if not overwrite and (os.path.exists(file_path) or os.path.exists(file_path + '.empty')):
+        if verbose:
+            print("  Skipping tract %d because output file exist" % tract)
+        return "skipped"
+
+    write_options = dict(write_options or {})
+    write_options.pop('row_group_size', None)  # one row group per patch
+
+    # Write to a temporary file so that an interrupted run does not leave a partial tract file
+    tmp_file_path = file_path + '.tmp'
+    pqwriter = None
+    patch_stats = []
+    try:
+        for patch in patches:
             if verbose:
-                print("  No entries for tract %d, patch %s" % (tract, patch))
-            open(file_path + '.empty', 'w').close()
-            continue
-
-        merged_cat.to_parquet(
-            file_path,
-            engine=parquet_engine,
-            compression=None,
-            index=False,
-        )
-        del merged_cat
+                print("Processing tract %d, patch %s" % (tract, patch))
+            merged_cat = merge_coadd_forced_src(butler, tract, patch, verbose=verbose,
+                                                return_arrow=True, **kwargs)
+            if merged_cat is None:
+                if verbose:
+                    print("  No entries for tract %d, patch %s" % (tract, patch))
+                continue
+
+            if pqwriter is None:
+                pqwriter = pq.ParquetWriter(tmp_file_path, merged_cat.schema,
+                                            **get_writer_kwargs(merged_cat.schema, **write_options))
+            pqwriter.write_table(merged_cat, row_group_size=max(merged_cat.num_rows, 1))
+            patch_stats.append(_get_patch_stats(patch, len(patch_stats), merged_cat))
+            del merged_cat
+
+        if pqwriter is not None and _HAS_ADD_KEY_VALUE_METADATA:
+            pqwriter.add_key_value_metadata({'patches': json.dumps(patch_stats)})
+    except BaseException:
+        if pqwriter is not None:
+            pqwriter.close()
+            os.remove(tmp_file_path)
+        raise
+
+    if pqwriter is None:
+        if verbose:
+            print("  No entries for tract %d" % tract)
+        open(file_path + '.empty', 'w').close()
+        return "empty"
+
+    pqwriter.close()
+    os.replace(tmp_file_path, file_path)
+
+    # pyarrow < 13 cannot add metadata after the schema is written; record the patch stats in a sidecar file
+    sidecar_path = file_path + '.patches.json'
+    if _HAS_ADD_KEY_VALUE_METADATA:
+        if os.path.exists(sidecar_path):
+            os.remove(sidecar_path)
+    else:
+        warnings.warn("pyarrow {} cannot add file metadata after writing; "
+                      "writing the patch stats to {}".format(pa.__version__, sidecar_path))
+        with open(sidecar_path + '.tmp', 'w') as f:
+            json.dump(patch_stats, f)
+        os.replace(sidecar_path + '.tmp', sidecar_path)
+    return "written"
 
 
 def merge_coadd_forced_src(butler, tract, patch, filters='ugrizy',
-                           verbose=False, return_pandas=True,
-                           debug=False):
+                           verbose=False, return_pandas=True, return_arrow=False,
+                           debug=False, n_filter_workers=1):
     """Load patch catalogs.  Return merged catalog across filters.
 
     butler: Butler object or str
@@ -112,6 +295,12 @@ def merge_coadd_forced_src(butler, tract, patch, filters='ugrizy',
         Join the catalogs for each filter on these fields
     filters: iterable of str
         Filter names to load
+    n_filter_workers: int
+        Number of threads used to read the catalogs of different filters concurrently
+    return_pandas: bool
+        Return a Pandas DataFrame (default) instead of an AstroPy Table
+    return_arrow: bool
+        Return a PyArrow Table (takes precedence over `return_pandas`)
 
     Returns
     --
@@ -129,19 +318,18 @@ def merge_coadd_forced_src(butler, tract, patch, filters='ugrizy',
             print("  ", e)
         return
 
-    ref_table = ref_table.asAstropy()
-    isPrimary = ref_table['detect_isPrimary']
+    isPrimary = afw_to_arrays(ref_table, columns=('detect_isPrimary',))['detect_isPrimary']
     if not isPrimary.any():
         if verbose:
             print("  No good isPrimary entries for tract {}, patch {}".format(tract, patch))
         return
 
-    ref_table = ref_table[isPrimary]
-    ref_table['tract'] = int(tract)
-    ref_table['patch'] = str(patch)
+    ref_table = afw_to_arrow(ref_table, rows=isPrimary)
+    n_rows = ref_table.num_rows
+    ref_table = ref_table.append_column('tract', pa.array(np.full(n_rows, int(tract), dtype=np.int64)))
+    ref_table = ref_table.append_column('patch', pa.array(np.full(n_rows, encode_patch_str(patch))))
 
-    tables_to_merge = dict()
-    for filter_this in filters:
+    def load_filter(filter_this):
         filter_name = filters.get(filter_this) if hasattr(filters, 'get') else filter_this
         this_data_id = dict(tract_patch_data_id, filter=filter_name)
         try:
@@ -150,44 +338,60 @@ def merge_coadd_forced_src(butler, tract, patch, filters='ugrizy',
         except NoResults as e:
             if verbose:
                 print("  ", e)
-            continue
+            return
 
-        cat = cat.asAstropy()
-        cat = cat[isPrimary]
+        cat = afw_to_arrow(cat, rows=isPrimary)
         if debug:
-            assert (cat['id'] == ref_table['id']).all()
-        del cat['id']
+            assert cat['id'].equals(ref_table['id'])
+        cat = cat.drop(['id'])
 
         # Magnitudes will be calculated in the GCR reader / DPDD formatting
         # For now we just extract the grey FLUXMAG0
         calib = butler.get('deepCoadd_calexp_photoCalib', this_data_id)
-        cat['FLUXMAG0'] = calib.getInstFluxAtZeroMagnitude()
+        cat = cat.append_column('FLUXMAG0', pa.array(np.full(n_rows, calib.getInstFluxAtZeroMagnitude())))
+
+        return cat
+
+    # The reads are I/O-latency bound, so the filters are read concurrently
+    # and the wall time of a patch is set by its slowest filter.
+    if n_filter_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_filter_workers) as executor:
+            cats = list(executor.map(load_filter, filters))
+    else:
+        cats = [load_filter(filter_this) for filter_this in filters]
 
-        tables_to_merge[filter_this] = cat
+    tables_to_merge = {filter_this: cat for filter_this, cat in zip(filters, cats) if cat is not None}
+    del cats
 
     try:
-        cat_dtype = next(iter(tables_to_merge.values())).dtype
+        filter_schema = next(iter(tables_to_merge.values())).schema
     except StopIteration:
         if verbose:
             print("  No filter can be found in deepCoadd_forced_src")
         return
 
     if debug:
-        assert all(cat_dtype == cat.dtype for cat in tables_to_merge.values())
+        assert all(filter_schema.equals(cat.schema) for cat in tables_to_merge.values())
 
-    merged_cat = ref_table  # merged_cat will start with the reference table
-    merged_cat.meta = None
+    # Missing filters are filled in one step from a template cached per schema,
+    # and all patches with the same inputs share one (cached) output schema.
+    fill_template = _get_fill_template(filter_schema)
+    columns = ref_table.columns  # merged_cat will start with the reference table
     for filter_this in filters:
-        if filter_this in tables_to_merge:
-            cat = tables_to_merge[filter_this]
-            for name in cat_dtype.names:
-                merged_cat['{}_{}'.format(filter_this, name)] = cat[name]
-            del cat, tables_to_merge[filter_this]
-        else:
-            for name, (dt, _) in cat_dtype.fields.items():
-                merged_cat['{}_{}'.format(filter_this, name)] = _get_fill_value(name, dt)
+        cat = tables_to_merge.pop(filter_this, None)
+        if cat is None:
+            cat = fill_template.get(n_rows)
+        columns.extend(cat.columns)
+        del cat
+
+    merged_schema = _get_merged_schema(ref_table.schema, filter_schema, tuple(filters))
+    merged_cat = pa.Table.from_arrays(columns, schema=merged_schema)
 
-    return merged_cat.to_pandas() if return_pandas else merged_cat
+    if return_arrow:
+        return merged_cat
+    if return_pandas:
+        return merged_cat.to_pandas()
+    return Table([column.to_numpy() for column in merged_cat.columns], names=merged_cat.column_names)
 
 
 if __name__ == '__main__':
@@ -208,6 +412,8 @@ Skymap patch[es] within each tract to process. Format should be "1,1^2,1^3,1"
 ''')
     parser.add_argument('--name', default='object',
                         help='Base name of files: <name>_tract_5062_11.parquet')
+    parser.add_argument('--tract-file', action='store_true',
+                        help='Write one file per tract (<name>_tract_5062.parquet) with one row group per patch.')
     parser.add_argument('-o', '--output-dir', default='./',
                         help='Output directory.  (default: %(default)s)')
     parser.add_argument('--verbose', default=True,
@@ -224,6 +430,11 @@ Specify the filter names. Can be comma separated if filter names are more than m
     parser.add_argument('--parquet_engine', dest='engine', default='pyarrow',
                         choices=['fastparquet', 'pyarrow'],
                         help="""(default: %(default)s)""")
+    add_write_option_arguments(parser)
+    parser.add_argument('--n-workers', type=int, default=1,
+                        help='Number of processes to process (tract, patch) units in parallel. (default: %(default)s)')
+    parser.add_argument('--n-filter-workers', type=int, default=1,
+                        help='Number of threads to read the catalogs of different filters concurrently. (default: %(default)s)')
     args = parser.parse_args()
 
     if args.hsc:
@@ -245,10 +456,27 @@ Specify the filter names. Can be comma separated if filter names are more than m
     if len(args.tract) > 1 and args.patches:
         warnings.warn("You specified more than 1 tract but only need partial patches??")
 
-    for tract in args.tract:
-        generate_object_catalog(
-            args.output_dir, args.repo, tract, args.patches,
-            overwrite=args.overwrite, verbose=args.verbose,
-            filename_prefix=args.name, parquet_engine=args.engine,
-            filters=filters
+    if args.tract_file and args.n_workers > 1:
+        parser.error("--tract-file writes the patches of a tract sequentially and does not support --n-workers > 1")
+
+    if args.n_workers > 1:
+        butler = Butler(args.repo)
+        units = [(tract, patch) for tract in args.tract for patch in resolve_patches(butler, tract, args.patches)]
+        del butler
+        run_patch_units(
+            process_object_patch, args.output_dir, args.repo, units,
+            n_workers=args.n_workers, verbose=args.verbose,
+            overwrite=args.overwrite, filename_prefix=args.name, parquet_engine=args.engine,
+            write_options=get_write_options_from_args(args),
+            filters=filters, n_filter_workers=args.n_filter_workers,
         )
+    else:
+        for tract in args.tract:
+            generate_object_catalog(
+                args.output_dir, args.repo, tract, args.patches,
+                overwrite=args.overwrite, verbose=args.verbose,
+                filename_prefix=args.name, parquet_engine=args.engine,
+                write_options=get_write_options_from_args(args),
+                tract_file=args.tract_file,
+                filters=filters, n_filter_workers=args.n_filter_workers,
+            )
@@ -6,18 +6,27 @@ needed for a DIA Object table following the LSST Data Products Definition Docume
 https://ls.st/dpdd
 """
 
+import glob
 import math
+import multiprocessing
 import os
 import sys
+import time
+import warnings
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from lsst.daf.persistence import Butler
 from lsst.daf.persistence.butlerExceptions import NoResults
 
 import GCRCatalogs
 
+from dia_object_stats import STAT_NAMES, calculate_dia_object_stats, DiaObjectStatsStore
+from parquet_write_options import get_writer_kwargs
+
 
 def load_patch(butler_or_repo, tract, patch,
                dataset_type='deepDiff_diaObject',
@@ -59,6 +68,105 @@ def load_patch(butler_or_repo, tract, patch,
     return cat
 
 
+DIA_SOURCE_STATS_COLUMNS = ['diaObjectId', 'psFlux', 'psFluxErr', 'filter']
+
+
+def get_neighbor_tracts(skymap, tract):
+    """Return the IDs of the tracts of a skymap that overlap `tract`.
+
+    Tracts are approximated by the circles around their centers that enclose their vertices.
+    """
+    def center_and_radius(tract_info):
+        center = tract_info.getCtrCoord()
+        radius = max(center.separation(vertex).asDegrees() for vertex in tract_info.getVertexList())
+        return center, radius
+
+    center, radius = center_and_radius(skymap[tract])
+    neighbors = []
+    for tract_info in skymap:
+        if tract_info.getId() == tract:
+            continue
+        other_center, other_radius = center_and_radius(tract_info)
+        if center.separation(other_center).asDegrees() < radius + other_radius:
+            neighbors.append(tract_info.getId())
+    return neighbors
+
+
+def _read_dia_source_tract(dia_source_table, tract=None, dia_object_ids=None):
+    """Read the DIA Sources of one tract (or of all tracts), optionally only those of some DIA Objects."""
+    if isinstance(dia_source_table, str):
+        pattern = os.path.join(dia_source_table, '*' if tract is None else str(tract), '*.parquet')
+        filters = None if dia_object_ids is None else [('diaObjectId', 'in', dia_object_ids.tolist())]
+        dfs = [pq.read_table(f, columns=DIA_SOURCE_STATS_COLUMNS, filters=filters).to_pandas()
+               for f in sorted(glob.glob(pattern))]
+        if not dfs:
+            return pd.DataFrame({c: [] for c in DIA_SOURCE_STATS_COLUMNS})
+        return pd.concat(dfs, ignore_index=True)
+
+    native_filters = None
+    if tract is not None:
+        native_filters = ['tract == {:d}'.format(tract)]
+    filters = None
+    if dia_object_ids is not None:
+        filters = [((lambda x: np.isin(x, dia_object_ids)), 'diaObjectId')]
+    return pd.DataFrame(dia_source_table.get_quantities(DIA_SOURCE_STATS_COLUMNS,
+                                                        filters=filters,
+                                                        native_filters=native_filters))
+
+
+def load_dia_sources(dia_source_table, dia_object_ids=None, tract=None, neighbor_tracts=()):
+    """Load the DIA Source columns needed for the DIA Object statistics.
+
+    Only the DIA Sources of the given tract and DIA Objects are loaded,
+    so that memory and I/O scale with a tract rather than the whole survey.
+
+    DIA Sources are partitioned by their own positions, so the sources of DIA Objects
+    near a tract boundary can be in a neighboring tract. The `neighbor_tracts`
+    (see `get_neighbor_tracts`) are therefore also read, filtered by `dia_object_ids`.
+    A warning reports the number of requested DIA Objects for which no DIA Sources were found.
+
+    Parameters
+    --
+    dia_source_table: GCRCatalogs catalog or str
+        The DIA Source Table, or the output directory of repartition_into_tracts.py
+        run on DIA Source Parquet files (<dia_source_dir>/<tract>/*.parquet).
+        For a GCRCatalogs catalog, `tract` native filters are pushed down to the reader
+        if it has a `tract` native quantity; otherwise, the whole table is read.
+    dia_object_ids: array_like, optional
+        Only keep the DIA Sources associated with these DIA Objects
+    tract: int, optional
+        Tract to load
+    neighbor_tracts: iterable of int, optional
+        Tracts next to `tract` to also load the DIA Sources of `dia_object_ids` from.
+        Requires `dia_object_ids`.
+
+    Returns
+    --
+    Pandas DataFrame with columns DIA_SOURCE_STATS_COLUMNS
+    """
+    if dia_object_ids is not None:
+        dia_object_ids = np.unique(np.asarray(dia_object_ids))
+
+    if not isinstance(dia_source_table, str) and 'tract' not in dia_source_table.list_all_native_quantities():
+        # No tract partitioning to take advantage of
+        tract, neighbor_tracts = None, ()
+    elif tract is None or dia_object_ids is None:
+        neighbor_tracts = ()
+
+    dfs = [_read_dia_source_tract(dia_source_table, tract, dia_object_ids)]
+    for neighbor_tract in neighbor_tracts:
+        dfs.append(_read_dia_source_tract(dia_source_table, neighbor_tract, dia_object_ids))
+    dia_source_df = pd.concat(dfs, ignore_index=True) if len(dfs) > 1 else dfs[0]
+
+    if dia_object_ids is not None:
+        n_missing = np.count_nonzero(~np.isin(dia_object_ids, dia_source_df['diaObjectId'].values))
+        if n_missing:
+            warnings.warn("No DIA Sources found for {} of {} DIA Objects{}; their statistics are NaN".format(
+                n_missing, len(dia_object_ids), '' if tract is None else ' of tract {}'.format(tract)))
+
+    return dia_source_df
+
+
 def calculate_stats_from_dia_source_table(dia_object_df, dia_source_table):
     """Calculate summary statistics for DIA Objects from the DIA Source table.
 
@@ -66,25 +174,28 @@ def calculate_stats_from_dia_source_table(dia_object_df, dia_source_table):
     --
     dia_object_df:
         Pandas DataFrame with list of diaObject IDs in 'diaObjectId'.
-    GCRCatalogs catalog:
-        The DIA Source Table
+    dia_source_table: GCRCatalogs catalog, str, Pandas DataFrame, or DiaObjectStatsStore
+        The DIA Source Table (see `load_dia_sources`),
+        DIA Sources already loaded with `load_dia_sources`,
+        or an incremental store of DIA Source sufficient statistics.
 
     Returns
     --
     Pandas DataFrame with additional summary columns added to input DataFrame.
     """
-    dia_flux_columns = ['psFlux', 'psFluxErr', 'filter']
-    stats = []
-    for dia_object_id in dia_object_df['diaObjectId']:
-        print(f'Calculating stats for {dia_object_id}')
-        condition = ((lambda x: x == dia_object_id), 'diaObjectId')
-        df = pd.DataFrame(dia_source_table.get_quantities(dia_flux_columns, filters=[condition]))
-        _stats = calculate_stats_for_one_dia_object(df)
-        _stats['diaObjectId'] = dia_object_id
-        stats.append(_stats)
-        print(_stats)
-
-    df_stats = pd.DataFrame(stats)
+    dia_object_ids = dia_object_df['diaObjectId'].values
+    if isinstance(dia_source_table, DiaObjectStatsStore):
+        df_stats = dia_source_table.summary(dia_object_ids)
+        return dia_object_df.merge(df_stats, how='left', on='diaObjectId')
+
+    if isinstance(dia_source_table, pd.DataFrame):
+        dia_source_df = dia_source_table
+    else:
+        # Read the DIA Source columns once, and only keep the sources of these DIA Objects
+        dia_source_df = load_dia_sources(dia_source_table, dia_object_ids)
+    dia_source_df = dia_source_df[np.isin(dia_source_df['diaObjectId'].values, dia_object_ids)]
+
+    df_stats = calculate_dia_object_stats(dia_source_df, dia_object_ids=dia_object_df['diaObjectId'].values)
     dia_object_df_with_stats = dia_object_df.merge(df_stats, how='left', on='diaObjectId')
 
     return dia_object_df_with_stats
@@ -117,13 +228,54 @@ def calculate_stats_for_one_dia_object(dia_source_df):
     return results
 
 
+def load_tract_dia_sources(butler, tract, patches, dia_source_table,
+                           dataset_type='deepDiff_diaObject', verbose=False):
+    """Load the DIA Sources needed for the statistics of the DIA Objects of a tract.
+
+    The DIA Sources are loaded before any patch is written,
+    so that the patches can then be streamed to the output file.
+    The DIA Object IDs of the tract are first collected from the patch catalogs,
+    and their DIA Sources are loaded from this tract and its neighbors (see `load_dia_sources`).
+
+    Returns
+    --
+    Pandas DataFrame with columns DIA_SOURCE_STATS_COLUMNS
+    """
+    dia_object_ids = []
+    for patch in patches:
+        try:
+            cat = butler.get(datasetType=dataset_type, dataId={'tract': tract, 'patch': patch})
+        except NoResults:
+            continue
+        dia_object_ids.append(np.array(cat['id']))
+    if not dia_object_ids:
+        return pd.DataFrame({c: [] for c in DIA_SOURCE_STATS_COLUMNS})
+
+    skymap = butler.get(datasetType='deepCoadd_skyMap')
+    neighbor_tracts = get_neighbor_tracts(skymap, tract)
+    dia_source_df = load_dia_sources(dia_source_table, np.concatenate(dia_object_ids),
+                                     tract=tract, neighbor_tracts=neighbor_tracts)
+
+    if verbose:
+        print("  Loaded {} DIA Sources for tract {} (and neighboring tracts {})".format(
+            len(dia_source_df), tract, neighbor_tracts))
+    return dia_source_df
+
+
+def _get_stats_columns(bands):
+    return ['{}_{}'.format(name, band) for band in bands for name in STAT_NAMES]
+
+
 def load_and_save_tract(repo, tract, filename,
                         dataset_type='deepDiff_diaObject',
                         patches=None,
+                        dia_source_table=None,
                         overwrite=True, verbose=False, **kwargs):
     """Save catalogs to Parquet from diaObject
 
-    Iterates through patches and then saves the tract as a whole to a Parquet file
+    Iterates through patches and appends each patch to the Parquet file of the tract
+    as it is loaded, so that only one patch is held in memory at a time.
+    The file is written to `filename`.tmp and renamed when complete.
 
     Parameters
     --
@@ -133,9 +285,24 @@ def load_and_save_tract(repo, tract, filename,
         Tract of sky region to load
     filename: str
         Filename for Parquet file.
+    dia_source_table: GCRCatalogs catalog, str, or DiaObjectStatsStore, optional
+        The DIA Source Table used to calculate summary statistics (see `load_dia_sources`).
+        Only the DIA Sources of this tract are loaded, once per tract (see `load_tract_dia_sources`).
+        With a DiaObjectStatsStore, the statistics are derived from its moments instead.
+        Every patch gets the statistics columns of all bands of the tract's DIA Sources
+        (all as float, NaN where a DIA Object has no DIA Sources in a band).
     overwrite: bool
         Overwrite an existing Parquet file.
+
+    Returns
+    --
+    Number of DIA Objects written
     """
+    if not overwrite and os.path.exists(filename):
+        if verbose:
+            print("  Skipping existing file {}".format(filename))
+        return 0
+
     butler = Butler(repo)
 
     if patches is None:
@@ -143,32 +310,119 @@ def load_and_save_tract(repo, tract, filename,
         skymap = butler.get(datasetType='deepCoadd_skyMap')
         patches = ['%d,%d' % patch.getIndex() for patch in skymap[tract]]
 
-    tract_cat_list = []
-    for patch in patches:
-        if verbose:
-            print("Processing tract %d, patch %s" % (tract, patch))
-        tract_patch_data_id = {'tract': tract, 'patch': patch}
-        try:
-            patch_cat = load_patch(butler, tract, patch, verbose=verbose, **kwargs)
-        except NoResults as e:
-            if verbose:
-                print(e)
-                print("  No good entries for tract %d, patch %s" % (tract, patch))
-            continue
-        if len(patch_cat) == 0:
+    stats_source = dia_source_table
+    bands = []
+    if isinstance(dia_source_table, DiaObjectStatsStore):
+        bands = np.unique(dia_source_table.moments['filter'].values).tolist()
+    elif dia_source_table is not None:
+        stats_source = load_tract_dia_sources(butler, tract, patches, dia_source_table,
+                                              dataset_type=dataset_type, verbose=verbose)
+        bands = np.unique(stats_source['filter'].values).tolist()
+
+    tmp_filename = filename + '.tmp'
+    writer = None
+    n_rows = 0
+    try:
+        for patch in patches:
             if verbose:
-                print("  No good entries for tract %d, patch %s" % (tract, patch))
-            continue
+                print("Processing tract %d, patch %s" % (tract, patch))
+            try:
+                patch_cat = load_patch(butler, tract, patch, dataset_type=dataset_type, verbose=verbose, **kwargs)
+            except NoResults as e:
+                if verbose:
+                    print(e)
+                    print("  No good entries for tract %d, patch %s" % (tract, patch))
+                continue
+            if len(patch_cat) == 0:
+                if verbose:
+                    print("  No good entries for tract %d, patch %s" % (tract, patch))
+                continue
+
+            if stats_source is not None:
+                n_columns = len(patch_cat.columns)
+                patch_cat = calculate_stats_from_dia_source_table(patch_cat, stats_source)
+                if writer is None:
+                    # Fix the columns of the tract from the first patch, plus the bands it lacks
+                    columns = list(patch_cat.columns)
+                    columns += [c for c in _get_stats_columns(bands) if c not in columns]
+                    stats_columns = columns[n_columns:]
+                patch_cat = patch_cat.reindex(columns=columns)
+                patch_cat[stats_columns] = patch_cat[stats_columns].astype(np.float64)
+
+            if writer is None:
+                table = pa.Table.from_pandas(patch_cat, preserve_index=False)
+                writer = pq.ParquetWriter(tmp_filename, table.schema, **get_writer_kwargs(table.schema))
+            else:
+                table = pa.Table.from_pandas(patch_cat, schema=writer.schema, preserve_index=False)
+            writer.write_table(table)
+            n_rows += len(patch_cat)
+    except BaseException:
+        if writer is not None:
+            writer.close()
+            os.remove(tmp_filename)
+        raise
+
+    if writer is None:
+        print("  No good entries found.  Not writing file.")
+        return 0
 
-        tract_cat_list.append(patch_cat)
+    writer.close()
+    os.replace(tmp_filename, filename)
+    return n_rows
 
-    tract_cat = pd.concat(tract_cat_list)
 
-    if len(tract_cat) == 0:
-        print("  No good entries found.  Not writing file.")
-        return
+def load_dia_source_table(dia_source_reader=None, dia_source_dir=None, dia_source_stats_store=None):
+    """Return the DIA Source table to pass to `load_and_save_tract` from the command-line options."""
+    if dia_source_stats_store is not None:
+        return DiaObjectStatsStore.load(dia_source_stats_store)
+    if dia_source_dir is not None:
+        return dia_source_dir
+    if dia_source_reader is not None:
+        return GCRCatalogs.load_catalog(dia_source_reader)
+    return None
+
+
+_worker_dia_source_table = None
 
-    tract_cat.to_parquet(filename)
+
+def _init_worker(dia_source_reader=None, dia_source_dir=None, dia_source_stats_store=None):
+    global _worker_dia_source_table  # pylint: disable=global-statement
+    _worker_dia_source_table = load_dia_source_table(dia_source_reader, dia_source_dir, dia_source_stats_store)
+
+
+def _load_and_save_tract_worker(kwargs):
+    t0 = time.time()
+    n_rows = load_and_save_tract(dia_source_table=_worker_dia_source_table, **kwargs)
+    return kwargs['tract'], n_rows, time.time() - t0
+
+
+def run_tracts(tract_kwargs, n_workers=1, verbose=False, **dia_source_options):
+    """Run `load_and_save_tract` for each tract with a pool of `n_workers` processes.
+
+    Each worker loads the DIA Source table (see `load_dia_source_table`) once
+    from `dia_source_options`, since GCRCatalogs catalogs cannot be sent to other processes.
+
+    Parameters
+    --
+    tract_kwargs: list of dict
+        Keyword arguments of `load_and_save_tract` (except dia_source_table) for each tract
+    n_workers: int
+        Number of worker processes
+    verbose: bool
+        Report progress and per-tract timings
+    """
+    my_print = print if verbose else (lambda *x: None)
+
+    n_tracts = len(tract_kwargs)
+    t_start = time.time()
+    with multiprocessing.Pool(n_workers, initializer=_init_worker, initargs=(
+            dia_source_options.get('dia_source_reader'),
+            dia_source_options.get('dia_source_dir'),
+            dia_source_options.get('dia_source_stats_store'))) as pool:
+        results = pool.imap_unordered(_load_and_save_tract_worker, tract_kwargs)
+        for i, (tract, n_rows, elapsed) in enumerate(results, 1):
+            my_print("[{}/{}] tract {}: {} DIA Objects ({:.1f} s)".format(i, n_tracts, tract, n_rows, elapsed))
+    my_print("Processed {} tracts in {:.1f} s with {} workers".format(n_tracts, time.time() - t_start, n_workers))
 
 
 if __name__ == '__main__':
@@ -191,6 +445,21 @@ Mostly intended for use if there is a different set of templates with a new data
                         help='''
 GCRCatalogs reader for DIA Source objects.
 Used to calculate summary statistics for DIA Object catalog.
+''')
+    parser.add_argument('--dia_source_dir', type=str, default=None,
+                        help='''
+Directory of tract-partitioned DIA Source Parquet files (<dia_source_dir>/<tract>/*.parquet),
+as written by repartition_into_tracts.py.
+Used instead of --dia_source_reader to only read the DIA Sources of each tract.
+DIA Sources are partitioned by their own positions, so the neighboring tracts
+are also read (filtered by diaObjectId) for the sources across a tract boundary.
+Sources beyond the neighboring tracts are not found;
+a warning reports the DIA Objects for which no DIA Sources were found.
+''')
+    parser.add_argument('--dia_source_stats_store', type=str, default=None,
+                        help='''
+Parquet file of DIA Source sufficient statistics, incrementally updated with dia_object_stats.py.
+Used instead of --dia_source_reader to derive the summary statistics without reading DIA Sources.
 ''')
     parser.add_argument('--base_dir', default=None,
                         help='''
@@ -213,19 +482,30 @@ A common use-case for this option is quick testing.
                         help='Turn off verbosity.')
     parser.add_argument('--debug', dest='debug', default=True,
                         action='store_true', help='Debug mode.')
+    parser.add_argument('--n_workers', type=int, default=1,
+                        help='Number of processes to process tracts in parallel. (default: %(default)s)')
 
     args = parser.parse_args(sys.argv[1:])
 
-    dia_source_table = None
-    if args.dia_source_reader is not None:
-        dia_source_table = GCRCatalogs.load_catalog(args.dia_source_reader)
+    dia_source_options = dict(
+        dia_source_reader=args.dia_source_reader,
+        dia_source_dir=args.dia_source_dir,
+        dia_source_stats_store=args.dia_source_stats_store,
+    )
 
+    tract_kwargs = []
     for tract in args.tract:
         filebase = '{:s}_tract_{:d}'.format(args.output_name, tract)
         filename = os.path.join(args.output_dir, filebase + '.parquet')
-        load_and_save_tract(args.repo, tract, filename,
-                            dataset_type=args.dataset,
-                            dia_source_table=dia_source_table,
-                            patches=args.patches,
-                            verbose=args.verbose,
-                            debug=args.debug)
+        tract_kwargs.append(dict(repo=args.repo, tract=tract, filename=filename,
+                                 dataset_type=args.dataset,
+                                 patches=args.patches,
+                                 verbose=args.verbose,
+                                 debug=args.debug))
+
+    if args.n_workers > 1:
+        run_tracts(tract_kwargs, n_workers=args.n_workers, verbose=args.verbose, **dia_source_options)
+    else:
+        dia_source_table = load_dia_source_table(**dia_source_options)
+        for kwargs in tract_kwargs:
+            load_and_save_tract(dia_source_table=dia_source_table, **kwargs)
@@ -2,7 +2,8 @@ import os
 import sys
 
 import numpy as np
-import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from lsst.daf.persistence import Butler
 from lsst.daf.persistence.butlerExceptions import NoResults
@@ -10,6 +11,8 @@ from lsst.daf.persistence.butlerExceptions import NoResults
 import GCRCatalogs
 from GCRCatalogs.dc2_forced_source import DC2ForcedSourceCatalog
 
+from afw_table_conversion import afw_to_pandas
+
 
 class DummyDC2ForcedSourceCatalog(GCRCatalogs.BaseGenericCatalog):
     """
@@ -46,34 +49,44 @@ def extract_and_save_visit(butler, visit, filename, object_table=None,
 
     columns_to_keep = list(DummyDC2ForcedSourceCatalog(dm_schema_version).required_native_quantities)
 
-    collected_cats = pd.DataFrame()
-    for dr in data_refs:
-        if not dr.datasetExists():
-            if verbose:
-                print("Skipping non-existent dataset: ", dr.dataId)
-            continue
-
-        if verbose:
-            print("Processing ", dr.dataId)
-        src_cat = load_detector(dr, object_table=object_table,
-                                columns_to_keep=columns_to_keep,
-                                verbose=verbose, **kwargs)
-        if len(src_cat) == 0:
-            if verbose:
-                print("  No good entries for ", dr.dataId)
-            continue
-        collected_cats = collected_cats.append(src_cat)
-
     if overwrite:
         if os.path.exists(filename):
             os.remove(filename)
 
-    if len(collected_cats) == 0:
-        if verbose:
-            print("No sources collected from ", data_refs.dataId)
-            return
+    # Each detector catalog is written out as one row group as soon as it is loaded,
+    # so that only one detector catalog is held in memory at a time.
+    # The schema is fixed by the first non-empty detector catalog.
+    pqwriter = None
+    try:
+        for dr in data_refs:
+            if not dr.datasetExists():
+                if verbose:
+                    print("Skipping non-existent dataset: ", dr.dataId)
+                continue
 
-    collected_cats.to_parquet(filename)
+            if verbose:
+                print("Processing ", dr.dataId)
+            src_cat = load_detector(dr, object_table=object_table,
+                                    columns_to_keep=columns_to_keep,
+                                    verbose=verbose, **kwargs)
+            if len(src_cat) == 0:
+                if verbose:
+                    print("  No good entries for ", dr.dataId)
+                continue
+
+            if pqwriter is None:
+                table = pa.Table.from_pandas(src_cat[columns_to_keep], preserve_index=False)
+                pqwriter = pq.ParquetWriter(filename, table.schema)
+            else:
+                table = pa.Table.from_pandas(src_cat, schema=pqwriter.schema, preserve_index=False)
+            pqwriter.write_table(table)
+            del src_cat, table
+    finally:
+        if pqwriter is not None:
+            pqwriter.close()
+
+    if pqwriter is None and verbose:
+        print("No sources collected from ", data_refs.dataId)
 
 
 def load_detector(data_ref, object_table=None, matching_radius=1,
@@ -108,8 +121,13 @@ def load_detector(data_ref, object_table=None, matching_radius=1,
         print("AFW photometry catalog schema version: {}".format(cat.schema.VERSION))
     flux_names = flux_field_names_per_schema_version[cat.schema.VERSION]
 
-    # Get a Pandas DataFrame out that we can more easily manipulate:
-    cat = cat.asAstropy().to_pandas()
+    # Get a Pandas DataFrame out that we can more easily manipulate.
+    # Only copy out the columns to keep, and those needed for calibration.
+    columns_to_load = None
+    if columns_to_keep is not None:
+        columns_to_load = set(columns_to_keep)
+        columns_to_load.update(flux_names.values())
+    cat = afw_to_pandas(cat, columns=columns_to_load)
 
     # Add visit, filter information as columns.
     # There's no separate metadata field so we redundantly include here
@@ -136,7 +154,8 @@ def load_detector(data_ref, object_table=None, matching_radius=1,
     cat['fluxmag0'] = calib.getInstFluxAtZeroMagnitude()
 
     # Restrict to columns that we need
-    cat = cat[columns_to_keep]
+    if columns_to_keep is not None:
+        cat = cat[columns_to_keep]
 
     return cat
 
@@ -1,16 +1,24 @@
 """
 merge_parquet_files.py
 """
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 
 try:
+    import pyarrow as pa
     import pyarrow.parquet as pq
 except ImportError:
     _HAS_PYARROW_ = False
 else:
     _HAS_PYARROW_ = True
 
+from parquet_raw_concat import concatenate_parquet_files
+from parquet_write_options import (
+    DEFAULT_COMPRESSION, get_writer_kwargs, write_dataframe, add_write_option_arguments,
+)
+
 
 def load_parquet_files_into_dataframe(parquet_files):
     return pd.concat(
@@ -20,31 +28,122 @@ def load_parquet_files_into_dataframe(parquet_files):
     )
 
 
+def unify_parquet_schemas(parquet_files):
+    """Unify the schemas of Parquet files.
+
+    Columns missing in some files are kept, and types are promoted
+    (e.g., int32 and int64 to int64, int and float to float) where possible.
+    The pandas metadata is dropped, because it describes one of the files only.
+    """
+    schemas = [pq.read_schema(f).remove_metadata() for f in parquet_files]
+    try:
+        return pa.unify_schemas(schemas, promote_options='permissive')
+    except TypeError:  # pyarrow < 14 does not support type promotion
+        return pa.unify_schemas(schemas)
+
+
+def _conform_to_schema(table, schema):
+    arrays = []
+    for field in schema:
+        if field.name in table.column_names:
+            column = table[field.name]
+            arrays.append(column if column.type == field.type else column.cast(field.type))
+        else:
+            arrays.append(pa.nulls(table.num_rows, field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def merge_parquet_files_streaming(parquet_files, output_file, row_group_size=None, **writer_kwargs):
+    """Merge Parquet files one row group at a time, with schema unification.
+
+    Only one input row group is held in memory at a time.
+    Columns missing in a file are filled with nulls.
+    """
+    schema = unify_parquet_schemas(parquet_files)
+    with pq.ParquetWriter(output_file, schema, **get_writer_kwargs(schema, **writer_kwargs)) as pqwriter:
+        for parquet_file in parquet_files:
+            pf = pq.ParquetFile(parquet_file)
+            for i in range(pf.num_row_groups):
+                t = _conform_to_schema(pf.read_row_group(i), schema)
+                pqwriter.write_table(t, row_group_size=row_group_size)
+                del t
+
+
+def iter_tables_prefetched(parquet_files, n_prefetch=0):
+    """Yield the Parquet files as Arrow tables, in order.
+
+    If n_prefetch > 0, up to n_prefetch upcoming files are read and decoded
+    by background threads while the caller is processing (e.g., writing) the current one.
+    """
+    if not n_prefetch or n_prefetch < 1:
+        for parquet_file in parquet_files:
+            yield pq.read_table(parquet_file)
+        return
+
+    with ThreadPoolExecutor(max_workers=n_prefetch) as executor:
+        pending = deque()
+        for parquet_file in parquet_files:
+            if len(pending) > n_prefetch:
+                yield pending.popleft().result()
+            pending.append(executor.submit(pq.read_table, parquet_file))
+        while pending:
+            yield pending.popleft().result()
+
+
 def run(input_files, output_file, sort_input_files=False,
-        parquet_engine='pyarrow', assume_consistent_schema=False):
+        parquet_engine='pyarrow', assume_consistent_schema=False,
+        compression=DEFAULT_COMPRESSION, compression_level=None,
+        dictionary=True, row_group_size=None, n_prefetch=0,
+        concat_row_groups=False):
     if sort_input_files:
         input_files = sorted(input_files)
 
+    if concat_row_groups:
+        # Row groups are copied as they are; the writer options do not apply.
+        concatenate_parquet_files(input_files, output_file)
+        return
+
     if assume_consistent_schema:
         if parquet_engine != "pyarrow" or not _HAS_PYARROW_:
             raise ValueError("Must use/have pyarrow when assume_consistent_schema is set to True")
         if not input_files:
             raise ValueError("No input files to merge")
 
-        t = pq.read_table(input_files[0])
-        with pq.ParquetWriter(output_file, t.schema, flavor='spark') as pqwriter:
-            pqwriter.write_table(t)
-            for input_file in input_files[1:]:
-                t = pq.read_table(input_file)
-                pqwriter.write_table(t)
+        pqwriter = None
+        try:
+            for t in iter_tables_prefetched(input_files, n_prefetch):
+                if pqwriter is None:
+                    writer_kwargs = get_writer_kwargs(t.schema, compression, compression_level, dictionary)
+                    pqwriter = pq.ParquetWriter(output_file, t.schema, flavor='spark', **writer_kwargs)
+                pqwriter.write_table(t, row_group_size=row_group_size)
+                del t
+        finally:
+            if pqwriter is not None:
+                pqwriter.close()
+
+    elif parquet_engine == "pyarrow" and _HAS_PYARROW_:
+        if not input_files:
+            raise ValueError("No input files to merge")
+
+        merge_parquet_files_streaming(
+            input_files,
+            output_file,
+            row_group_size=row_group_size,
+            compression=compression,
+            compression_level=compression_level,
+            dictionary=dictionary,
+        )
 
     else:
         df = load_parquet_files_into_dataframe(input_files)
-        df.to_parquet(
+        write_dataframe(
+            df,
             output_file,
-            engine=parquet_engine,
-            compression=None,
-            index=False,
+            parquet_engine=parquet_engine,
+            compression=compression,
+            compression_level=compression_level,
+            dictionary=dictionary,
+            row_group_size=row_group_size,
         )
 
 
@@ -52,7 +151,8 @@ if __name__ == "__main__":
     from argparse import ArgumentParser, RawTextHelpFormatter
     usage = """
     Merge set of parquet files into one Parquet file.
-    The schema must agree.
+    With pyarrow, the schemas are unified (missing columns are filled with nulls,
+    and types are promoted where possible), and files are merged one row group at a time.
 
     Examples
     --
@@ -75,6 +175,16 @@ if __name__ == "__main__":
                         help="""(default: %(default)s)""")
     parser.add_argument('--assume-consistent-schema', action='store_true',
                         help='Assume schema is consistent across input files')
+    parser.add_argument('--concat-row-groups', action='store_true',
+                        help="""
+Copy the row groups of the input files into the output without decoding them,
+rewriting only the footer. All input files must have an identical schema.
+The compression and encoding options are ignored.""")
+    parser.add_argument('--n-prefetch', type=int, default=0,
+                        help="""
+Number of input files to read ahead in background threads
+while the current one is written (only with --assume-consistent-schema). (default: %(default)s)""")
+    add_write_option_arguments(parser)
     args = parser.parse_args()
 
     if not args.input_files:
@@ -1,8 +1,13 @@
 import os
 import sys
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from lsst.geom import radians
 try:
@@ -14,13 +19,16 @@ import lsst.daf.base
 from lsst.daf.persistence import Butler
 from lsst.daf.persistence.butlerExceptions import NoResults
 
-from astropy.coordinates import SkyCoord, matching
-import astropy.units as u
+from scipy.spatial import cKDTree
 
 import GCRCatalogs
 from GCRCatalogs.dc2_source import DC2SourceCatalog
 from GCRCatalogs.dc2_dia_source import DC2DiaSourceCatalog
 
+from afw_table_conversion import afw_to_arrays, afw_to_pandas
+from make_association_sidecar import AssociationSidecarSet, attach_object_table_bundle
+from sky_coordinates import radec_rad_to_xyz, radec_deg_to_xyz
+
 
 class DummyDC2SourceCatalog(GCRCatalogs.BaseGenericCatalog):
     """
@@ -54,11 +62,36 @@ class DummyDC2DiaSourceCatalog(GCRCatalogs.BaseGenericCatalog):
         return set(self._translate_quantities(self.list_all_quantities()))
 
 
+def _map_in_order(func, iterable, n_workers=1, max_in_flight=None):
+    """Yield (item, func(item)) in input order, evaluating func in a thread pool.
+
+    At most max_in_flight (default: 2 * n_workers) items are being processed
+    or waiting to be consumed at any time, which bounds the memory held by results.
+    """
+    if n_workers is None or n_workers <= 1:
+        for item in iterable:
+            yield item, func(item)
+        return
+
+    max_in_flight = max_in_flight or 2 * n_workers
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= max_in_flight:
+                item_done, future = pending.popleft()
+                yield item_done, future.result()
+        while pending:
+            item_done, future = pending.popleft()
+            yield item_done, future.result()
+
+
 def extract_and_save_visit(butler, visit, filename,
                            dataset='src',
                            object_table=None,
                            object_dataset=None,
                            dm_schema_version=3,
+                           n_detector_workers=1,
                            overwrite=True, verbose=False, debug=False,
                            **kwargs):
     """Save catalogs to Parquet from visit-level source catalogs.
@@ -73,6 +106,9 @@ def extract_and_save_visit(butler, visit, filename,
         Visit to process
     filename: str
         Filename for output Parquet file.
+    n_detector_workers: int
+        Number of threads to load detectors concurrently.
+        The output order of the detectors is preserved.
     overwrite: bool
         Overwrite an existing parquet file.
     """
@@ -88,37 +124,51 @@ def extract_and_save_visit(butler, visit, filename,
 
     columns_to_keep = list(dummy_catalog.required_native_quantities)
 
-    collected_cats = pd.DataFrame()
-    for dr in data_refs:
+    if overwrite:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    # Each detector catalog is written out as one row group as soon as it is loaded,
+    # so that only one detector catalog is held in memory at a time.
+    # The schema is fixed by the first non-empty detector catalog.
+    def load_one_detector(dr):
         if not dr.datasetExists():
             if verbose:
                 print("Skipping non-existent dataset: ", dr.dataId)
-            continue
+            return
 
         if verbose:
             print("Processing ", dr.dataId)
-        src_cat = load_detector(dr,
-                                dataset=dataset,
-                                object_table=object_table,
-                                object_dataset=object_dataset,
-                                columns_to_keep=columns_to_keep,
-                                verbose=verbose, debug=debug, **kwargs)
-        if len(src_cat) == 0:
-            if verbose:
-                print("  No good entries for ", dr.dataId)
-            continue
-        collected_cats = collected_cats.append(src_cat)
-
-    if overwrite:
-        if os.path.exists(filename):
-            os.remove(filename)
+        return load_detector(dr,
+                             dataset=dataset,
+                             object_table=object_table,
+                             object_dataset=object_dataset,
+                             columns_to_keep=columns_to_keep,
+                             verbose=verbose, debug=debug, **kwargs)
+
+    pqwriter = None
+    try:
+        for dr, src_cat in _map_in_order(load_one_detector, data_refs, n_detector_workers):
+            if src_cat is None:
+                continue
+            if len(src_cat) == 0:
+                if verbose:
+                    print("  No good entries for ", dr.dataId)
+                continue
 
-    if len(collected_cats) == 0:
-        if verbose:
-            print("No sources collected from ", data_refs.dataId)
-            return
+            if pqwriter is None:
+                table = pa.Table.from_pandas(src_cat[columns_to_keep], preserve_index=False)
+                pqwriter = pq.ParquetWriter(filename, table.schema)
+            else:
+                table = pa.Table.from_pandas(src_cat, schema=pqwriter.schema, preserve_index=False)
+            pqwriter.write_table(table)
+            del src_cat, table
+    finally:
+        if pqwriter is not None:
+            pqwriter.close()
 
-    collected_cats.to_parquet(filename)
+    if pqwriter is None and verbose:
+        print("No sources collected from ", data_refs.dataId)
 
 
 def load_detector(data_ref,
@@ -135,7 +185,7 @@ def load_detector(data_ref,
     --
     data_ref:
         Butler data_ref
-    object_table:  AFW Table, Pandas DataFrame, or AstroPy Table
+    object_table:  ObjectTableIndex, Pandas DataFrame, or AstroPy Table
         Table of at least ('id', 'ra', 'dec') for spatial matching to assign
         the associated Object Id.
     matching_radius:  float [arcsec]
@@ -168,8 +218,14 @@ def load_detector(data_ref,
         print("AFW photometry catalog schema version: {}".format(cat.schema.VERSION))
     flux_names = flux_field_names_per_schema_version[cat.schema.VERSION]
 
-    # Get a Pandas DataFrame out that we can more easily manipulate:
-    cat = cat.asAstropy().to_pandas()
+    # Get a Pandas DataFrame out that we can more easily manipulate.
+    # Only copy out the columns to keep, and those needed for calibration and association.
+    columns_to_load = None
+    if columns_to_keep is not None:
+        columns_to_load = set(columns_to_keep)
+        columns_to_load.update(flux_names.values())
+        columns_to_load.update(('coord_ra', 'coord_dec'))
+    cat = afw_to_pandas(cat, columns=columns_to_load)
     if debug:
         print("Looking at {} entries".format(len(cat)))
 
@@ -212,12 +268,14 @@ def load_detector(data_ref,
         cat['objectId'] = object_id
 
     # Restrict to columns that we need
-    cat = cat[columns_to_keep]
+    if columns_to_keep is not None:
+        cat = cat[columns_to_keep]
 
     return cat
 
 
-def associate_object_ids(cat, data_ref=None, object_table=None, object_dataset=None, **kwargs):
+def associate_object_ids(cat, data_ref=None, object_table=None, object_dataset=None,
+                         ref_cache=None, **kwargs):
     """Wrapper for development to easily switch
     Object-Table based
     coadd file based
@@ -228,6 +286,7 @@ def associate_object_ids(cat, data_ref=None, object_table=None, object_dataset=N
         associated_ids = associate_object_ids_to_coadd(cat,
                                                        data_ref=data_ref,
                                                        object_dataset=object_dataset,
+                                                       ref_cache=ref_cache,
                                                        **kwargs)
     elif object_table is not None:
         associated_ids = associate_object_ids_to_table(cat, object_table=object_table, **kwargs)
@@ -237,8 +296,17 @@ def associate_object_ids(cat, data_ref=None, object_table=None, object_dataset=N
 
 def associate_object_ids_to_coadd(cat, data_ref=None,
                                   object_dataset='deepCoadd_ref',
+                                  ref_cache=None,
                                   verbose=True, **kwargs):
-    """Load and match to deepCoadd or deepDiff_diaObject references."""
+    """Load and match to deepCoadd or deepDiff_diaObject references.
+
+    ref_cache: ReferenceCatalogCache
+        Cache of the reference catalogs (and their spatial indices).
+        Pass the same cache for all detectors and visits so that each reference
+        catalog is only read once.  If None, a new cache is used for this call only.
+    """
+    if ref_cache is None:
+        ref_cache = ReferenceCatalogCache()
 
     skymap = data_ref.get(datasetType='deepCoadd_skyMap')
 
@@ -268,24 +336,17 @@ def associate_object_ids_to_coadd(cat, data_ref=None,
             tract_patch_data_id['patch'] = patch_str
             if verbose:
                 print("Searching ", tract_patch_data_id)
-            try:
-                ref_table = data_ref.getButler().get(datasetType=object_dataset,
-                                                     dataId=tract_patch_data_id)
-            except NoResults:
+            ref_index = ref_cache.get(data_ref.getButler(), object_dataset, tract_patch_data_id)
+            if ref_index is None:
                 if verbose:
                     print("No results found for ", tract_patch_data_id)
                 continue
 
-            ref_table = ref_table.asAstropy().to_pandas()
-            # Rename RA, Dec columns to match associate_object_ids_to_table
-            # expectations
-            ref_table['ra'] = np.rad2deg(ref_table['coord_ra'])
-            ref_table['dec'] = np.rad2deg(ref_table['coord_dec'])
             # Restrict ref_table to isPrimary?
 
             # We get back and array of matching object IDs
             # Cat rows with no matches get a -1 entry.
-            these_associated_ids = associate_object_ids_to_table(cat, object_table=ref_table,
+            these_associated_ids = associate_object_ids_to_table(cat, object_table=ref_index,
                                                                  verbose=verbose, **kwargs)
             associated_id_table.append(these_associated_ids)
 
@@ -299,6 +360,111 @@ def associate_object_ids_to_coadd(cat, data_ref=None,
     return associated_ids
 
 
+class ObjectTableIndex():
+    """Spatial index over an Object Table for associating sources to objects.
+
+    The KD-tree over the unit vectors of the objects is built once,
+    so that each detector catalog is associated with a single query
+    rather than by filtering the full table and building a new tree each time.
+
+    Parameters
+    --
+    object_table:  pandas DataFrame, AstroPy Table, or dict
+        Table of at least ('id', 'ra', 'dec'), with RA, Dec in degrees.
+    """
+    def __init__(self, object_table):
+        self.ids = np.asarray(object_table['id'], dtype=np.int64)
+        self.tree = cKDTree(radec_deg_to_xyz(object_table['ra'], object_table['dec']))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        """Approximate memory used by the ids and the KD-tree."""
+        return self.ids.nbytes + self.tree.data.nbytes + self.tree.indices.nbytes
+
+    def query(self, ra, dec, matching_radius=1):
+        """Return the ID of the closest object within matching_radius [arcsec].
+
+        ra, dec are in radians.
+        Entries with no match will be -1.
+        """
+        # Chord length on the unit sphere corresponding to the matching radius
+        max_chord = 2 * np.sin(np.deg2rad(float(matching_radius) / 3600) / 2)
+        distance, idx = self.tree.query(radec_rad_to_xyz(ra, dec), distance_upper_bound=max_chord)
+        matched = np.isfinite(distance)
+        associated_ids = np.full(len(distance), -1, dtype=np.int64)
+        associated_ids[matched] = self.ids[idx[matched]]
+        return associated_ids
+
+
+class ReferenceCatalogCache():
+    """LRU cache of coadd reference catalogs, keyed by (dataset, tract, patch).
+
+    Each entry only keeps the id, RA, Dec of the reference catalog
+    as an ObjectTableIndex (i.e., together with its spatial index).
+    The least recently used entries are dropped once the total size
+    exceeds max_bytes.  Missing reference catalogs are cached too.
+
+    Parameters
+    --
+    max_bytes: int
+        Memory budget for the cached entries.
+    """
+    def __init__(self, max_bytes=2 * 1024**3):
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, butler, dataset, data_id):
+        """Return ObjectTableIndex of the reference catalog, or None if it does not exist."""
+        key = (dataset, data_id['tract'], data_id['patch'])
+        with self._lock:
+            if key in self._cache:
+                self.hits += 1
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            self.misses += 1
+
+        # Read outside of the lock so that detectors loaded in other threads are not blocked
+        try:
+            ref_table = butler.get(datasetType=dataset, dataId=data_id)
+        except NoResults:
+            index = None
+        else:
+            # Only id, RA, Dec [rad -> deg] are needed for association
+            ref_table = afw_to_arrays(ref_table, columns=('id', 'coord_ra', 'coord_dec'))
+            index = ObjectTableIndex({'id': ref_table['id'],
+                                      'ra': np.rad2deg(ref_table['coord_ra']),
+                                      'dec': np.rad2deg(ref_table['coord_dec'])})
+            del ref_table
+
+        with self._lock:
+            if key in self._cache:
+                # Another thread has loaded the same catalog in the meantime
+                return self._cache[key]
+            self._cache[key] = index
+            if index is not None:
+                self.nbytes += index.nbytes
+            while self.nbytes > self.max_bytes and len(self._cache) > 1:
+                _, evicted = self._cache.popitem(last=False)
+                if evicted is not None:
+                    self.nbytes -= evicted.nbytes
+
+        return index
+
+    def summary(self):
+        return "Reference catalog cache: %d hits, %d misses, %d entries, %.1f MB" % \
+            (self.hits, self.misses, len(self), self.nbytes / 1024**2)
+
+
 def associate_object_ids_to_table(cat, object_table=None, matching_radius=1,
                                   verbose=True):
     """Return object ID associated with each entry in cat.
@@ -312,53 +478,25 @@ def associate_object_ids_to_table(cat, object_table=None, matching_radius=1,
     Parameters
     --
     cat: pandas DataFrame
-    object_table:  pandas DataFrame
+    object_table:  ObjectTableIndex, AssociationSidecarSet, or pandas DataFrame
+        If not already an ObjectTableIndex or AssociationSidecarSet, an index will be built for this call.
+        To associate many catalogs against the same table, build the index once and pass it here.
     matching_radius: float [arcsec]
 
     Notes
     --
-    cat and object_table are assumed to have RA, Dec units of rad
-
+    cat is assumed to have RA, Dec units of rad, and object_table units of deg.
     """
-    # Let's first try the stupid way:
-    # Explicitly iterate through cat
-    # Construct a subset of object
-
-    min_ra, max_ra = np.min(cat['coord_ra']), np.max(cat['coord_ra'])
-    min_dec, max_dec = np.min(cat['coord_dec']), np.max(cat['coord_dec'])
-    edge_buffer = np.deg2rad(10 * matching_radius / 3600)
-    # Note this is wrong.  There's no cos(dec)
-    ra_range = (np.rad2deg(min_ra - edge_buffer), np.rad2deg(max_ra + edge_buffer))
-    dec_range = (np.rad2deg(min_dec - edge_buffer), np.rad2deg(max_dec + edge_buffer))
-
-    if verbose:
-        print("Extract objects from Object Table with RA, Dec in ranges:")
-        print(ra_range, dec_range)
-    in_source_catalog_area = (ra_range[0] < object_table['ra']) & \
-                             (object_table['ra'] < ra_range[1]) & \
-                             (dec_range[0] < object_table['dec']) & \
-                             (object_table['dec'] < dec_range[1])
-    this_object_table = object_table[in_source_catalog_area]
-    if verbose:
-        print("Found %d objects in Object Table in region" % len(this_object_table))
+    if not isinstance(object_table, (ObjectTableIndex, AssociationSidecarSet)):
+        object_table = ObjectTableIndex(object_table)
 
-    if len(this_object_table) < 1:
+    if len(object_table) < 1:
         # Return an array of -1
-        return np.zeros(len(cat)) - 1
-
-    this_object_table_skyCoor = SkyCoord(this_object_table['ra'],
-                                         this_object_table['dec'],
-                                         unit=(u.deg, u.deg))
-    cat_skyCoor = SkyCoord(cat['coord_ra'], cat['coord_dec'], unit=(u.rad, u.rad))
+        return np.zeros(len(cat), dtype=np.int64) - 1
 
-    idx, sep2d, _ = matching.match_coordinates_sky(cat_skyCoor, this_object_table_skyCoor)
-    associated_ids = np.asarray(this_object_table.iloc[idx]['id'], dtype=int)
-
-    # Remove the associations that were too far away.
-    w = sep2d > matching_radius * u.arcsec
-    # sentinel value for no match.
-    # Assumes input catalog uses only non-negative numbers for object Ids
-    associated_ids[w] = -1
+    associated_ids = object_table.query(cat['coord_ra'], cat['coord_dec'], matching_radius)
+    if verbose:
+        print("Associated %d of %d sources to objects" % (np.count_nonzero(associated_ids >= 0), len(cat)))
 
     return associated_ids
 
@@ -420,7 +558,11 @@ if __name__ == '__main__':
     * If an Object Table reader is provided through '--object_reader', then the catalog
     read by that Generic Catalog Reader will be used to match Object IDs.
 
-    * If this reader is not provided, then source catalogs will be matched against
+    * If per-tract association sidecar files (from make_association_sidecar.py) are provided
+    through '--object_sidecar_dir', only the tracts that each visit touches are memory-mapped
+    and used to match Object IDs.
+
+    * If neither is provided, then source catalogs will be matched against
     the the merged detection reference coadds
     (which are what are processed to generate the Object Table).
 
@@ -429,6 +571,8 @@ if __name__ == '__main__':
     The Object Table reader approach requires DPDD Object Table to be locally available
     It requires 2.5 GB per process to load the table into memory for Run 1.2.
     For larger catalogs, this memory usage will increase.
+    With '--object_table_bundle /dev/shm/<name>', the id, ra, dec are instead written once
+    per node to a memory-mapped bundle shared by all processes on the node.
     It also requires the Object Table to have been generated.
 
     Running without the Object Table loaded into memory is more naturally parallel
@@ -437,6 +581,9 @@ if __name__ == '__main__':
     because of the slow performance in reading AFW tables from FITS files.
     Compounding this, each merged reference detection catalog is loaded multiple times
     as many visits different will cover a given tract+path on the sky.
+    To mitigate this, the reference catalogs (id, ra, dec, and their spatial index)
+    are kept in an LRU cache shared across all detectors and visits of one run.
+    Its memory budget is set with '--ref_cache_mb'.
     """
     parser = ArgumentParser(description=usage,
                             formatter_class=RawTextHelpFormatter)
@@ -449,8 +596,24 @@ E.g., "src", "deepCoadd_diaSrc"(default: %(default)s)
 """)
     parser.add_argument('--object_reader', type=str, default=None,
                         help='Name of Object Table reader.')
+    parser.add_argument('--object_sidecar_dir', type=str, default=None,
+                        help="""
+Root directory of the per-tract association sidecar files of the Object Table
+(see make_association_sidecar.py).  Takes precedence over --object_reader.
+""")
+    parser.add_argument('--object_table_bundle', type=str, default=None,
+                        help="""
+Directory of a read-only, memory-mapped Object Table bundle, e.g., in /dev/shm.
+If it does not exist yet, it is created from --object_reader by the first process,
+and all processes on the node then share it instead of loading their own copy.
+""")
     parser.add_argument('--object_dataset', type=str, default=None,
                         help='Name of Object dataset type.  E.g., "deepCoadd", "deepDiff_diaObject".')
+    parser.add_argument('--ref_cache_mb', type=float, default=2048,
+                        help="""
+Memory budget [MB] for caching the reference catalogs of --object_dataset
+across detectors and visits. (default: %(default)s)
+""")
     parser.add_argument('--base_dir', default=None,
                         help='Override the base_dir setting of the reader.  This is motivated by the need to run on different file systems due to problems sometimes locking files for access from the compute nodes.')
     parser.add_argument('--visits', type=int, nargs='+',
@@ -464,6 +627,10 @@ visit_file are appended to the list specified in visits.
     parser.add_argument('--radius', default=1,
                         help="""
 Matching radius for object association [arcsec].  (default: %(default)s'
+""")
+    parser.add_argument('--n_detector_workers', type=int, default=1,
+                        help="""
+Number of threads to load the detectors of a visit concurrently. (default: %(default)s)
 """)
     parser.add_argument('--output_name', default='src',
                         help='Base name of files: <output_name>_visit_0235062.parquet')
@@ -486,7 +653,15 @@ v3: '_instFlux', '_instFluxError'
     args = parser.parse_args(sys.argv[1:])
 
     object_table = None
-    if args.object_reader:
+    if args.object_sidecar_dir:
+        # Tracts are memory-mapped on demand, so the Object Table is never loaded in full
+        object_table = AssociationSidecarSet(args.object_sidecar_dir)
+    elif args.object_table_bundle:
+        object_table = attach_object_table_bundle(args.object_table_bundle,
+                                                  reader=args.object_reader,
+                                                  base_dir=args.base_dir,
+                                                  silent=not args.verbose)
+    elif args.object_reader:
         config_override = {}
         if args.base_dir:
             config_override['base_dir'] = args.base_dir
@@ -503,6 +678,9 @@ v3: '_instFlux', '_instFluxError'
 
         del cat
 
+        # Build the spatial index once and reuse it for all visits and detectors
+        object_table = ObjectTableIndex(object_table)
+
     if args.visit_file:
         if not args.visits:
             args.visits = []
@@ -516,6 +694,10 @@ v3: '_instFlux', '_instFluxError'
 
     args.visits = unique_in_order(args.visits)
 
+    ref_cache = None
+    if args.object_dataset:
+        ref_cache = ReferenceCatalogCache(max_bytes=args.ref_cache_mb * 1024**2)
+
     butler = Butler(args.repo)
     for visit in args.visits:
         filebase = '{:s}_visit_{:d}'.format(args.output_name, visit)
@@ -525,5 +707,10 @@ v3: '_instFlux', '_instFluxError'
                                object_dataset=args.object_dataset,
                                object_table=object_table,
                                matching_radius=args.radius,
+                               ref_cache=ref_cache,
+                               n_detector_workers=args.n_detector_workers,
                                dm_schema_version=args.dm_schema_version,
                                verbose=args.verbose, debug=args.debug)
+
+    if ref_cache is not None:
+        print(ref_cache.summary())
@@ -8,6 +8,8 @@ import pandas as pd
 from lsst.daf.persistence import Butler
 from lsst.daf.persistence.butlerExceptions import NoResults
 
+from afw_table_conversion import afw_to_arrays, afw_to_pandas
+
 
 def valid_identifier_name(name):
     """Return a valid Python identifier name from input string.
@@ -113,6 +115,7 @@ def load_patch(butler_or_repo, tract, patch,
                fields_to_join=('id',),
                filters={'u': 'u', 'g': 'g', 'r': 'r', 'i': 'i', 'z': 'z', 'y': 'y'},
                trim_colnames_for_fits=False,
+               columns=None,
                verbose=False,
                debug=False
                ):
@@ -130,6 +133,12 @@ def load_patch(butler_or_repo, tract, patch,
         Filter names to load
     trim_colnames_for_fits: bool
         Trim column names to satisfy the FITS standard character limit of <68.
+    columns: iterable of str, optional
+        Native column names of the merged catalog to load
+        (e.g., `required_native_quantities` of DummyDC2ObjectCatalog),
+        with per-filter columns prefixed by the filter name.
+        Only these columns (plus the join fields and the fluxes needed for calibration)
+        are copied out of the AFW catalogs.  If None, load all columns.
 
     Returns
     --
@@ -145,15 +154,20 @@ def load_patch(butler_or_repo, tract, patch,
     try:
         ref_table = butler.get(datasetType='deepCoadd_ref',
                                dataId=tract_patch_data_id)
-        ref_table = ref_table.asAstropy().to_pandas()
     except NoResults as e:
         if verbose:
             print(" ", e)
         return pd.DataFrame()
 
+    ref_columns = None
+    if columns is not None:
+        ref_columns = set(columns)
+        ref_columns.update(fields_to_join)
+        ref_columns.add('detect_isPrimary')
 
-    isPrimary = ref_table['detect_isPrimary']
-    ref_table = ref_table[isPrimary]
+    # Only copy the isPrimary rows out of the AFW catalogs
+    isPrimary = afw_to_arrays(ref_table, columns=('detect_isPrimary',))['detect_isPrimary']
+    ref_table = afw_to_pandas(ref_table, columns=ref_columns, rows=isPrimary)
     if len(ref_table) == 0:
         if verbose:
             print("  No good isPrimary entries for tract %d, patch %s" % (tract, patch))
@@ -184,15 +198,16 @@ def load_patch(butler_or_repo, tract, patch,
             print("AFW photometry catalog schema version: {}".format(cat.schema.VERSION))
         flux_names = flux_field_names_per_schema_version[cat.schema.VERSION]
 
-        # Convert the AFW table to an AstroPy table
-        # because it's much easier to add column to an AstroPy table
-        # than it is to set up a new schema for an AFW table.
-        # cat = cat.asAstropy()
-
-        # Try instead out converting the AFW->AstroPy->Pandas per cat
-        # hoping to avoid memory copy
+        # Copy only the requested isPrimary rows and columns
+        # out of the AFW table into a Pandas DataFrame.
         # Then join in memory space.
-        cat = cat.asAstropy().to_pandas()
+        filt_columns = None
+        if columns is not None:
+            filt_prefix = '%s_' % filt
+            filt_columns = {c[len(filt_prefix):] for c in columns if c.startswith(filt_prefix)}
+            filt_columns.update(fields_to_join)
+            filt_columns.update(flux_names.values())
+        cat = afw_to_pandas(cat, columns=filt_columns, rows=isPrimary)
 
         calib = butler.get('deepCoadd_calexp_photoCalib', this_data)
         calib.setThrowOnNegativeFlux(False)
@@ -212,11 +227,9 @@ def load_patch(butler_or_repo, tract, patch,
         cat['modelfit_SNR'] = np.abs(cat[flux_names['modelfit_flux']] /
                                      cat[flux_names['modelfit_flux_err']])
 
-        cat = cat[isPrimary]
-
         merge_filter_cats[filt] = cat
 
-    merged_patch_cat = ref_table
+    filter_cats = []
     for filt in filters:
         if filt not in merge_filter_cats:
             continue
@@ -226,10 +239,24 @@ def load_patch(butler_or_repo, tract, patch,
             continue
         # Rename duplicate columns with prefix of filter
         prefix_columns(cat, filt, fields_to_skip=fields_to_join)
-        # Merge metadata with concatenation
-        merged_patch_cat = pd.merge(merged_patch_cat, cat,
-                                    on=fields_to_join,
-                                    sort=False)
+        filter_cats.append(cat)
+
+    if all(is_row_aligned(ref_table, cat, fields_to_join) for cat in filter_cats):
+        # The forced photometry catalogs are row-aligned with the reference catalog,
+        # so all filters can be joined positionally in a single concatenation.
+        fields_to_join = list(fields_to_join)
+        # (prefix_columns has turned the index into str, so it is reset to that of ref_table)
+        merged_patch_cat = pd.concat(
+            [ref_table] + [cat.drop(columns=fields_to_join).set_axis(ref_table.index, axis=0)
+                           for cat in filter_cats],
+            axis=1)
+    else:
+        merged_patch_cat = ref_table
+        for cat in filter_cats:
+            # Merge metadata with concatenation
+            merged_patch_cat = pd.merge(merged_patch_cat, cat,
+                                        on=fields_to_join,
+                                        sort=False)
 
     if trim_colnames_for_fits:
         # FITS column names can't be longer that 68 characters
@@ -239,6 +266,21 @@ def load_patch(butler_or_repo, tract, patch,
     return merged_patch_cat
 
 
+def is_row_aligned(ref_table, cat, fields_to_join=('id',)):
+    """Check if two Pandas DataFrames have identical join fields, row by row.
+
+    >>> import pandas as pd
+    >>> ref = pd.DataFrame({'id': [1, 2, 3], 'ra': [0.1, 0.2, 0.3]})
+    >>> is_row_aligned(ref, pd.DataFrame({'id': [1, 2, 3], 'flux': [1., 2., 3.]}))
+    True
+    >>> is_row_aligned(ref, pd.DataFrame({'id': [1, 3, 2], 'flux': [1., 3., 2.]}))
+    False
+    """
+    if len(ref_table) != len(cat):
+        return False
+    return all(np.array_equal(ref_table[field].values, cat[field].values) for field in fields_to_join)
+
+
 def trim_long_colnames(cat):
     """Trim long column names in an AstroPy Table by specific replacements.
 
@@ -319,6 +361,10 @@ A common use-case for this option is quick testing.
                         help='Turn off verbosity.')
     parser.add_argument('--hsc', dest='hsc', action='store_true',
                         help='Uses HSC filters')
+    parser.add_argument('--dpdd_columns_only', action='store_true',
+                        help='Only load the native columns required for the DPDD columns.')
+    parser.add_argument('--dm_schema_version', default=3, type=int,
+                        help='DM schema version used to determine the DPDD columns. (default: %(default)s)')
     args = parser.parse_args(sys.argv[1:])
 
     if args.hsc:
@@ -327,9 +373,14 @@ A common use-case for this option is quick testing.
     else:
         filters = {'u': 'u', 'g': 'g', 'r': 'r', 'i': 'i', 'z': 'z', 'y': 'y'}
 
+    columns = None
+    if args.dpdd_columns_only:
+        from trim_tract_cat import DummyDC2ObjectCatalog
+        columns = DummyDC2ObjectCatalog(args.dm_schema_version).required_native_quantities
+
     for tract in args.tract:
         filebase = '{:s}_tract_{:d}'.format(args.name, tract)
         filename = os.path.join(args.output_dir, filebase + '.hdf5')
         load_and_save_tract(args.repo, tract, filename,
                             patches=args.patches, verbose=args.verbose,
-                            filters=filters)
+                            filters=filters, columns=columns)
@@ -15,6 +15,8 @@ import pandas as pd
 import astropy.units as u
 from astropy.coordinates import SkyCoord, search_around_sky
 
+from patch_encoding import encode_patch_str
+
 __all__ = ["merge_truth_per_tract", "match_object_with_merged_truth"]
 
 
@@ -90,6 +92,10 @@ def merge_truth_per_tract(input_dir, truth_types=("_hp", "star_", "sn_"), valida
             if f"flux_{band}" not in df.columns:
                 df[f"flux_{band}"] = np.float32(0)
 
+        # Files repartitioned by older versions of `repartition_into_tracts.py` store patch as a "x,y" string
+        if not pd.api.types.is_integer_dtype(df["patch"]):
+            df["patch"] = encode_patch_str(df["patch"].values)
+
         df["truth_type"] = np.int32(type_code)
         df["cosmodc2_hp"] = np.int64(healpix)
         df["cosmodc2_id"] = df["id"] if type_code == 1 else np.int64(-1)
@@ -117,6 +123,13 @@ def _flux_to_mag(flux):
         return (flux * u.nJy).to_value(u.ABmag)  # pylint: disable=no-member
 
 
+def _segment_starts(sorted_keys):
+    """Return the indices where each run of equal values in `sorted_keys` starts."""
+    if not len(sorted_keys):
+        return np.zeros(0, dtype=np.intp)
+    return np.flatnonzero(np.concatenate([[True], sorted_keys[1:] != sorted_keys[:-1]]))
+
+
 def match_object_with_merged_truth(
     truth_cat,
     object_cat,
@@ -198,82 +211,71 @@ def match_object_with_merged_truth(
     dmag[~np.isfinite(dmag)] = dmag_limit
     dmag[dmag > dmag_limit] = dmag_limit
 
-    # Create a dataframe to store the matched entries
-    matched = pd.DataFrame.from_dict({
-        "object_idx": object_idx,
-        "truth_idx": truth_idx,
-        "match_sep": sep.arcsec,
-        "dmag": dmag,
-    })
-    del object_idx, truth_idx, sep, dmag
-
-    # Mark nearest neighbor
-    matched = matched.sort_values("match_sep")
-    matched["is_nearest_neighbor"] = ~matched.duplicated("object_idx", keep="first")
-
-    # Choose the smallest `dmag` if less than dmag_limit; otherwise, choose the smallest `match_sep`
-    matched = matched.sort_values(["dmag", "match_sep"]).drop_duplicates("object_idx", keep="first")
-    matched["is_good_match"] = matched.eval("(match_sep < @sep_limit_arcsec) & (dmag < @dmag_limit)")
-    del matched["dmag"]
+    # Sort the pairs by object, then by `dmag`, then by `match_sep`, in a single lexsort,
+    # so that the first pair of each object is its match:
+    # choose the smallest `dmag` if less than dmag_limit; otherwise, choose the smallest `match_sep`
+    sep = sep.arcsec
+    order = np.lexsort((sep, dmag, object_idx))
+    object_idx, truth_idx, sep, dmag = object_idx[order], truth_idx[order], sep[order], dmag[order]
+    del order
+    pair_start = _segment_starts(object_idx)
+    matched_object_idx = object_idx[pair_start]
+
+    n_object = len(object_cat)
+    match_truth_idx = np.empty(n_object, dtype=np.int64)
+    match_sep = np.empty(n_object, dtype=np.float64)
+    is_good_match = np.zeros(n_object, dtype=bool)
+    is_nearest_neighbor = np.ones(n_object, dtype=bool)
+
+    match_truth_idx[matched_object_idx] = truth_idx[pair_start]
+    match_sep[matched_object_idx] = sep[pair_start]
+    is_good_match[matched_object_idx] = (sep[pair_start] < sep_limit_arcsec) & (dmag[pair_start] < dmag_limit)
+    # Mark nearest neighbor: the match has the smallest `match_sep` among all pairs of its object
+    if len(pair_start):
+        is_nearest_neighbor[matched_object_idx] = sep[pair_start] <= np.minimum.reduceat(sep, pair_start)
+    del object_idx, truth_idx, sep, dmag, pair_start
     if truth_cat_has_mag:
         del truth_cat[mag_label_truth]
 
     # For any *object* entries that do not have a match yet, find the nearest neighbor
     # We already know these are not good matches because their `match_sep` must be > sep_limit_arcsec
-    object_not_matched_mask = np.in1d(object_cat.index.values, matched["object_idx"].values, True, True)
-    truth_idx, sep, _ = object_sc[object_not_matched_mask].match_to_catalog_sky(truth_sc)
-    matched = matched.append(
-        pd.DataFrame.from_dict({
-            "object_idx": object_cat.index.values[object_not_matched_mask],
-            "truth_idx": truth_idx,
-            "match_sep": sep.arcsec,
-            "is_nearest_neighbor": True,
-            "is_good_match": False,
-        }),
-        ignore_index=True,
-    )
-    del object_not_matched_mask, truth_idx, sep, object_sc, truth_sc
+    object_not_matched_mask = np.ones(n_object, dtype=bool)
+    object_not_matched_mask[matched_object_idx] = False
+    if object_not_matched_mask.any():
+        truth_idx, sep, _ = object_sc[object_not_matched_mask].match_to_catalog_sky(truth_sc)
+        match_truth_idx[object_not_matched_mask] = truth_idx
+        match_sep[object_not_matched_mask] = sep.arcsec
+        del truth_idx, sep
+    del matched_object_idx, object_not_matched_mask, object_sc, truth_sc
 
     # Check if any truth entry appears more than once, and mark those
-    matched = matched.sort_values("match_sep")
-    matched["is_unique_truth_entry"] = ~matched.duplicated("truth_idx", keep="first")
-
-    # Reorder `matched` so that it has exactly the same row order as `object_cat`
-    matched = matched.sort_values("object_idx")
-    if validate:
-        (matched["object_idx"] == object_cat.index.values).all()
-    matched["match_objectId"] = object_cat["objectId"].values
-
-    # Select and reorder needed columns to be organized
-    matched = matched[["truth_idx", "match_objectId", "match_sep", "is_good_match", "is_nearest_neighbor", "is_unique_truth_entry"]]
+    # (only the entry with the smallest `match_sep` is unique)
+    order = np.lexsort((match_sep, match_truth_idx))
+    is_unique_truth_entry = np.zeros(n_object, dtype=bool)
+    is_unique_truth_entry[order[_segment_starts(match_truth_idx[order])]] = True
+    del order
 
     # Append the remaining (i.e., unmatched) truth entries to generate the full table
     # We know all these rows we are appending are not matched!
-    full_table = matched.append(
-        pd.DataFrame.from_dict({
-            "truth_idx": truth_cat.index.values[np.in1d(truth_cat.index.values, matched["truth_idx"].values, invert=True)],
-            "match_objectId": -1,
-            "match_sep": -1.0,
-            "is_good_match": False,
-            "is_nearest_neighbor": False,
-            "is_unique_truth_entry": True,
-        }),
-        ignore_index=True,
-    )
-    del matched
-
-    full_table = pd.merge(truth_cat, full_table, left_index=True, right_on="truth_idx", how="outer").sort_index()
+    truth_not_matched_mask = np.ones(len(truth_cat), dtype=bool)
+    truth_not_matched_mask[match_truth_idx] = False
+    n_truth_not_matched = np.count_nonzero(truth_not_matched_mask)
 
     if validate:
-        objid = full_table["match_objectId"].values
-        assert (objid[objid > -1] == object_cat["objectId"].values).all()
-        del objid
-        truth_idx = full_table["truth_idx"].values[full_table["is_unique_truth_entry"].values]
+        truth_idx = np.concatenate([match_truth_idx[is_unique_truth_entry], np.flatnonzero(truth_not_matched_mask)])
         truth_idx.sort()
-        assert (truth_idx == truth_cat.index.values).all()
+        assert (truth_idx == np.arange(len(truth_cat))).all()
         del truth_idx
 
-    del full_table["truth_idx"]
+    full_table = truth_cat.iloc[np.concatenate([match_truth_idx, np.flatnonzero(truth_not_matched_mask)])]
+    full_table = full_table.reset_index(drop=True)
+    full_table["match_objectId"] = np.concatenate([
+        object_cat["objectId"].values, np.full(n_truth_not_matched, -1, dtype=np.int64)
+    ])
+    full_table["match_sep"] = np.concatenate([match_sep, np.full(n_truth_not_matched, -1.0)])
+    full_table["is_good_match"] = np.concatenate([is_good_match, np.zeros(n_truth_not_matched, dtype=bool)])
+    full_table["is_nearest_neighbor"] = np.concatenate([is_nearest_neighbor, np.zeros(n_truth_not_matched, dtype=bool)])
+    full_table["is_unique_truth_entry"] = np.concatenate([is_unique_truth_entry, np.ones(n_truth_not_matched, dtype=bool)])
 
     return full_table
 
@@ -0,0 +1,297 @@
+"""
+parquet_raw_concat.py
+
+Concatenate Parquet files that share the same schema without decoding any data.
+
+The column chunks of all input row groups are copied byte for byte into the
+output file, and only the footer (the Thrift-encoded FileMetaData) is rewritten,
+with the row groups of all inputs and their byte offsets shifted to the new positions.
+Merging the patch files of a tract is then about as fast as copying the bytes.
+
+pyarrow does not expose writing raw column chunks, so the footer is decoded and
+re-encoded here with a minimal Thrift compact protocol codec. All fields are
+preserved, except the page index (column/offset index) references, which are dropped
+because the offset index stores absolute page offsets that would need to be rewritten.
+Encrypted files are not supported.
+"""
+import os
+import struct
+
+__all__ = ["concatenate_parquet_files"]
+
+_MAGIC = b"PAR1"
+
+# Thrift compact protocol types
+_BOOL_TRUE, _BOOL_FALSE, _BYTE, _I16, _I32, _I64, _DOUBLE, _BINARY, _LIST, _SET, _MAP, _STRUCT = range(1, 13)
+
+# Field ids in parquet.thrift
+_FILE_METADATA_NUM_ROWS = 3
+_FILE_METADATA_ROW_GROUPS = 4
+_FILE_METADATA_SCHEMA = 2
+_FILE_METADATA_ENCRYPTION_ALGORITHM = 8
+_ROW_GROUP_COLUMNS = 1
+_ROW_GROUP_FILE_OFFSET = 5
+_ROW_GROUP_ORDINAL = 7
+_COLUMN_CHUNK_FILE_OFFSET = 2
+_COLUMN_CHUNK_META_DATA = 3
+_COLUMN_CHUNK_PAGE_INDEX_FIELDS = (4, 5, 6, 7)
+_COLUMN_CHUNK_CRYPTO_METADATA = 8
+_COLUMN_META_DATA_OFFSET_FIELDS = (9, 10, 11, 14)
+
+
+class _Reader(object):
+    def __init__(self, buf):
+        self.buf = buf
+        self.pos = 0
+
+    def byte(self):
+        b = self.buf[self.pos]
+        self.pos += 1
+        return b
+
+    def varint(self):
+        result = shift = 0
+        while True:
+            b = self.byte()
+            result |= (b & 0x7F) << shift
+            if not b & 0x80:
+                return result
+            shift += 7
+
+    def zigzag(self):
+        n = self.varint()
+        return (n >> 1) ^ -(n & 1)
+
+    def read(self, size):
+        data = self.buf[self.pos:self.pos + size]
+        self.pos += size
+        return bytes(data)
+
+
+def _read_value(reader, ttype):
+    if ttype in (_BOOL_TRUE, _BOOL_FALSE):
+        # Booleans inside containers are one byte; keep the raw byte
+        return reader.byte()
+    if ttype == _BYTE:
+        return reader.byte()
+    if ttype in (_I16, _I32, _I64):
+        return reader.zigzag()
+    if ttype == _DOUBLE:
+        return reader.read(8)
+    if ttype == _BINARY:
+        return reader.read(reader.varint())
+    if ttype in (_LIST, _SET):
+        header = reader.byte()
+        size, elem_type = header >> 4, header & 0x0F
+        if size == 15:
+            size = reader.varint()
+        return elem_type, [_read_value(reader, elem_type) for _ in range(size)]
+    if ttype == _MAP:
+        size = reader.varint()
+        if not size:
+            return None, None, []
+        types = reader.byte()
+        key_type, value_type = types >> 4, types & 0x0F
+        return key_type, value_type, [
+            (_read_value(reader, key_type), _read_value(reader, value_type)) for _ in range(size)
+        ]
+    if ttype == _STRUCT:
+        return _read_struct(reader)
+    raise ValueError("Unknown Thrift compact type {}".format(ttype))
+
+
+def _read_struct(reader):
+    """Decode a struct into a list of [field_id, type, value]."""
+    fields = []
+    field_id = 0
+    while True:
+        header = reader.byte()
+        if header == 0:
+            return fields
+        delta, ttype = header >> 4, header & 0x0F
+        field_id = field_id + delta if delta else reader.zigzag()
+        value = None if ttype in (_BOOL_TRUE, _BOOL_FALSE) else _read_value(reader, ttype)
+        fields.append([field_id, ttype, value])
+
+
+def _write_varint(out, n):
+    while True:
+        if n < 0x80:
+            out.append(n)
+            return
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+
+
+def _write_zigzag(out, n):
+    _write_varint(out, (n << 1) ^ (n >> 63))
+
+
+def _write_value(out, ttype, value):
+    if ttype in (_BOOL_TRUE, _BOOL_FALSE, _BYTE):
+        out.append(value)
+    elif ttype in (_I16, _I32, _I64):
+        _write_zigzag(out, value)
+    elif ttype == _DOUBLE:
+        out.extend(value)
+    elif ttype == _BINARY:
+        _write_varint(out, len(value))
+        out.extend(value)
+    elif ttype in (_LIST, _SET):
+        elem_type, values = value
+        if len(values) < 15:
+            out.append((len(values) << 4) | elem_type)
+        else:
+            out.append(0xF0 | elem_type)
+            _write_varint(out, len(values))
+        for v in values:
+            _write_value(out, elem_type, v)
+    elif ttype == _MAP:
+        key_type, value_type, items = value
+        _write_varint(out, len(items))
+        if items:
+            out.append((key_type << 4) | value_type)
+            for k, v in items:
+                _write_value(out, key_type, k)
+                _write_value(out, value_type, v)
+    elif ttype == _STRUCT:
+        _write_struct(out, value)
+    else:
+        raise ValueError("Unknown Thrift compact type {}".format(ttype))
+
+
+def _write_struct(out, fields):
+    last_id = 0
+    for field_id, ttype, value in sorted(fields, key=lambda f: f[0]):
+        delta = field_id - last_id
+        if 0 < delta <= 15:
+            out.append((delta << 4) | ttype)
+        else:
+            out.append(ttype)
+            _write_zigzag(out, field_id)
+        if ttype not in (_BOOL_TRUE, _BOOL_FALSE):
+            _write_value(out, ttype, value)
+        last_id = field_id
+    out.append(0)
+
+
+def _get_field(fields, field_id):
+    for field in fields:
+        if field[0] == field_id:
+            return field
+    return None
+
+
+def _shift_row_group(row_group, shift, ordinal):
+    for field in row_group:
+        if field[0] == _ROW_GROUP_FILE_OFFSET:
+            field[2] += shift
+        elif field[0] == _ROW_GROUP_ORDINAL:
+            field[2] = ordinal
+
+    for column_chunk in _get_field(row_group, _ROW_GROUP_COLUMNS)[2][1]:
+        if _get_field(column_chunk, _COLUMN_CHUNK_CRYPTO_METADATA) is not None:
+            raise ValueError("Encrypted column chunks are not supported")
+        column_chunk[:] = [f for f in column_chunk if f[0] not in _COLUMN_CHUNK_PAGE_INDEX_FIELDS]
+        for field in column_chunk:
+            if field[0] == _COLUMN_CHUNK_FILE_OFFSET:
+                field[2] += shift
+            elif field[0] == _COLUMN_CHUNK_META_DATA:
+                for meta_field in field[2]:
+                    if meta_field[0] in _COLUMN_META_DATA_OFFSET_FIELDS:
+                        meta_field[2] += shift
+
+
+def _read_footer(path):
+    """Return (FileMetaData fields, end of the data section) of a Parquet file."""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+        f.seek(0)
+        if f.read(4) != _MAGIC:
+            raise ValueError("{} is not a (unencrypted) Parquet file".format(path))
+        f.seek(file_size - 8)
+        footer_length, magic = struct.unpack("<i4s", f.read(8))
+        if magic != _MAGIC:
+            raise ValueError("{} is not a (unencrypted) Parquet file".format(path))
+        data_end = file_size - 8 - footer_length
+        f.seek(data_end)
+        footer = _read_struct(_Reader(f.read(footer_length)))
+    if _get_field(footer, _FILE_METADATA_ENCRYPTION_ALGORITHM) is not None:
+        raise ValueError("Encrypted Parquet files are not supported: {}".format(path))
+    return footer, data_end
+
+
+def _copy_range(fsrc, fdst, start, stop, chunk_size=64 * 1024 * 1024):
+    fsrc.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        data = fsrc.read(min(chunk_size, remaining))
+        if not data:
+            raise IOError("Unexpected end of file")
+        fdst.write(data)
+        remaining -= len(data)
+
+
+def concatenate_parquet_files(input_files, output_file):
+    """Concatenate Parquet files with identical schemas by copying their row groups.
+
+    The key-value metadata (e.g., pandas metadata) and creator of the first file are kept.
+
+    Parameters
+    --
+    input_files : list of str
+    output_file : str
+
+    Returns
+    --
+    Number of row groups in the output file
+    """
+    if not input_files:
+        raise ValueError("No input files to merge")
+
+    try:
+        return _concatenate(input_files, output_file)
+    except Exception:
+        # Do not leave a partial output file behind
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        raise
+
+
+def _concatenate(input_files, output_file):
+    merged_footer = None
+    merged_row_groups = []
+    num_rows = 0
+
+    with open(output_file, "wb") as fdst:
+        fdst.write(_MAGIC)
+        for input_file in input_files:
+            footer, data_end = _read_footer(input_file)
+            if merged_footer is None:
+                merged_footer = footer
+                schema = _get_field(footer, _FILE_METADATA_SCHEMA)
+            elif _get_field(footer, _FILE_METADATA_SCHEMA) != schema:
+                raise ValueError("Schema of {} differs from that of {}".format(input_file, input_files[0]))
+
+            # The data section [4, data_end) is copied to the current output position
+            shift = fdst.tell() - len(_MAGIC)
+            for row_group in _get_field(footer, _FILE_METADATA_ROW_GROUPS)[2][1]:
+                _shift_row_group(row_group, shift, len(merged_row_groups))
+                merged_row_groups.append(row_group)
+            num_rows += _get_field(footer, _FILE_METADATA_NUM_ROWS)[2]
+
+            with open(input_file, "rb") as fsrc:
+                _copy_range(fsrc, fdst, len(_MAGIC), data_end)
+
+        _get_field(merged_footer, _FILE_METADATA_NUM_ROWS)[2] = num_rows
+        row_groups_field = _get_field(merged_footer, _FILE_METADATA_ROW_GROUPS)
+        row_groups_field[2] = (row_groups_field[2][0], merged_row_groups)
+
+        out = bytearray()
+        _write_struct(out, merged_footer)
+        fdst.write(out)
+        fdst.write(struct.pack("<i", len(out)))
+        fdst.write(_MAGIC)
+
+    return len(merged_row_groups)
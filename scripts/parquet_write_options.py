@@ -0,0 +1,123 @@
+"""
+parquet_write_options.py
+
+Shared Parquet writer options (compression codec, dictionary encoding, row-group size)
+for the scripts that write object, metacal, and merged Parquet files.
+
+Dictionary encoding is only enabled for categorical-like columns
+(strings, and tract/patch/filter/visit/detector), where it pays off.
+Boolean flags are left out, as Parquet stores them bit-packed regardless,
+and floating-point measurement columns are written plain.
+"""
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    _HAS_PYARROW_ = False
+else:
+    _HAS_PYARROW_ = True
+
+__all__ = [
+    "COMPRESSION_CHOICES", "DEFAULT_COMPRESSION", "DICTIONARY_COLUMN_NAMES",
+    "get_dictionary_columns", "get_writer_kwargs", "write_arrow_table", "write_dataframe",
+    "add_write_option_arguments", "get_write_options_from_args",
+]
+
+COMPRESSION_CHOICES = ('zstd', 'snappy', 'gzip', 'lz4', 'brotli', 'none')
+DEFAULT_COMPRESSION = 'snappy'
+DICTIONARY_COLUMN_NAMES = frozenset(('tract', 'patch', 'filter', 'visit', 'detector'))
+
+
+def _require_pyarrow():
+    if not _HAS_PYARROW_:
+        raise ImportError("pyarrow is required to write Parquet files with these options")
+
+
+def get_dictionary_columns(schema):
+    """Return the names of the categorical columns in an Arrow schema."""
+    _require_pyarrow()
+    names = []
+    for field in schema:
+        if (
+            field.name in DICTIONARY_COLUMN_NAMES or
+            pa.types.is_string(field.type) or
+            pa.types.is_large_string(field.type) or
+            pa.types.is_dictionary(field.type)
+        ):
+            names.append(field.name)
+    return names
+
+
+def get_writer_kwargs(schema, compression=DEFAULT_COMPRESSION, compression_level=None, dictionary=True):
+    """Return keyword arguments for `pq.ParquetWriter` / `pq.write_table`.
+
+    Parameters
+    --
+    schema : pyarrow.Schema
+    compression : str
+        One of COMPRESSION_CHOICES
+    compression_level : int, optional
+        Codec-specific compression level
+    dictionary : bool
+        If True, dictionary-encode categorical columns only.
+        If False, disable dictionary encoding.
+    """
+    kwargs = dict(
+        compression=None if compression in (None, 'none') else compression,
+        use_dictionary=get_dictionary_columns(schema) if dictionary else False,
+    )
+    if compression_level is not None:
+        kwargs['compression_level'] = compression_level
+    return kwargs
+
+
+def write_arrow_table(table, file_path, compression=DEFAULT_COMPRESSION,
+                      compression_level=None, dictionary=True, row_group_size=None):
+    """Write a PyArrow Table to a Parquet file."""
+    _require_pyarrow()
+    pq.write_table(
+        table,
+        file_path,
+        row_group_size=row_group_size,
+        **get_writer_kwargs(table.schema, compression, compression_level, dictionary)
+    )
+
+
+def write_dataframe(df, file_path, parquet_engine='pyarrow', compression=DEFAULT_COMPRESSION,
+                    compression_level=None, dictionary=True, row_group_size=None):
+    """Write a Pandas DataFrame (without its index) to a Parquet file.
+
+    With the fastparquet engine, only `compression` and `row_group_size` are used.
+    """
+    if parquet_engine == 'pyarrow':
+        _require_pyarrow()
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        write_arrow_table(table, file_path, compression, compression_level, dictionary, row_group_size)
+        return
+
+    kwargs = dict(compression=None if compression in (None, 'none') else compression.upper())
+    if row_group_size:
+        kwargs['row_group_offsets'] = row_group_size
+    df.to_parquet(file_path, engine=parquet_engine, index=False, **kwargs)
+
+
+def add_write_option_arguments(parser):
+    """Add the Parquet writer options to an argparse parser."""
+    parser.add_argument('--compression', default=DEFAULT_COMPRESSION, choices=COMPRESSION_CHOICES,
+                        help='Parquet compression codec. (default: %(default)s)')
+    parser.add_argument('--compression-level', type=int,
+                        help='Codec-specific compression level (pyarrow only).')
+    parser.add_argument('--no-dictionary', dest='dictionary', action='store_false',
+                        help='Disable dictionary encoding of categorical columns (pyarrow only).')
+    parser.add_argument('--row-group-size', type=int,
+                        help="Maximum number of rows per row group. (default: the engine's default)")
+
+
+def get_write_options_from_args(args):
+    """Return the Parquet writer options parsed by `add_write_option_arguments` as a dict."""
+    return dict(
+        compression=args.compression,
+        compression_level=args.compression_level,
+        dictionary=args.dictionary,
+        row_group_size=args.row_group_size,
+    )
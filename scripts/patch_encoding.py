@@ -0,0 +1,83 @@
+"""
+patch_encoding.py
+
+Compact integer encoding of skymap patches.
+
+A patch with index (x, y), i.e., "x,y" in a Butler data ID,
+is stored as the integer x * 100 + y (e.g., "3,5" -> 305) in an int16 column,
+instead of an object-dtype string column.
+Use `decode_patch_str` to convert back to the "x,y" string form.
+"""
+import numpy as np
+
+__all__ = [
+    "PATCH_ENCODING_BASE", "PATCH_DTYPE",
+    "encode_patch", "decode_patch", "encode_patch_str", "decode_patch_str",
+]
+
+PATCH_ENCODING_BASE = 100
+PATCH_DTYPE = np.int16
+
+
+def _scalar_or_array(arr):
+    return arr[()] if arr.ndim == 0 else arr
+
+
+def encode_patch(patch_x, patch_y):
+    """Encode patch index (x, y) as x * 100 + y.
+
+    Works on scalars or arrays.
+
+    >>> int(encode_patch(3, 5))
+    305
+    >>> encode_patch([0, 7], [1, 6]).tolist()
+    [1, 706]
+    """
+    patch_x = np.asarray(patch_x)
+    patch_y = np.asarray(patch_y)
+    if ((patch_x < 0) | (patch_x >= PATCH_ENCODING_BASE) | (patch_y < 0) | (patch_y >= PATCH_ENCODING_BASE)).any():
+        raise ValueError("patch index must be between 0 and {}".format(PATCH_ENCODING_BASE - 1))
+    return _scalar_or_array((patch_x * PATCH_ENCODING_BASE + patch_y).astype(PATCH_DTYPE))
+
+
+def decode_patch(patch):
+    """Decode encoded patch(es) into patch index (x, y).
+
+    >>> [int(p) for p in decode_patch(305)]
+    [3, 5]
+    """
+    patch = np.asarray(patch, dtype=np.int64)
+    return _scalar_or_array(patch // PATCH_ENCODING_BASE), _scalar_or_array(patch % PATCH_ENCODING_BASE)
+
+
+def encode_patch_str(patch):
+    """Encode patch string(s) in "x,y" format.
+
+    Works on a single string or an array of strings.
+
+    >>> int(encode_patch_str("3,5"))
+    305
+    >>> encode_patch_str(["0,1", "7,6", "0,1"]).tolist()
+    [1, 706, 1]
+    """
+    patch = np.asarray(patch, dtype=str)
+    unique_patches, inverse = np.unique(patch.ravel(), return_inverse=True)
+    unique_index = np.array([p.split(",") for p in unique_patches], dtype=np.int64).reshape(-1, 2)
+    codes = np.asarray(encode_patch(unique_index[:, 0], unique_index[:, 1]))
+    return _scalar_or_array(codes[inverse].reshape(patch.shape))
+
+
+def decode_patch_str(patch):
+    """Convert encoded patch(es) back to string(s) in "x,y" format.
+
+    >>> decode_patch_str(305)
+    '3,5'
+    >>> decode_patch_str([1, 706]).tolist()
+    ['0,1', '7,6']
+    """
+    patch = np.asarray(patch, dtype=np.int64)
+    unique_codes, inverse = np.unique(patch.ravel(), return_inverse=True)
+    patch_x, patch_y = decode_patch(unique_codes)
+    unique_patches = np.array(["{},{}".format(x, y) for x, y in zip(patch_x, patch_y)], dtype=str)
+    result = unique_patches[inverse].reshape(patch.shape)
+    return str(result[()]) if result.ndim == 0 else result
@@ -0,0 +1,101 @@
+"""
+patch_scheduler.py
+
+Spread (tract, patch) units of a coadd catalog extraction across a process pool.
+
+Each worker process opens its own Butler instance once (in the pool initializer)
+and reuses it for all the units it processes.
+The per-patch work is done by a module-level function with signature
+
+    process_patch(output_dir, butler, tract, patch, **kwargs) -> status
+
+(e.g., `make_object_catalog.process_object_patch`), where status is one of
+"written", "empty", or "skipped", so that the existing `.empty` and
+`--overwrite` skip logic is honoured in the workers.
+"""
+import re
+import time
+import multiprocessing
+from functools import partial
+
+from lsst.daf.persistence import Butler
+
+__all__ = ["resolve_patches", "run_patch_units"]
+
+_worker_butler = None
+
+
+def resolve_patches(butler, tract, patches=None):
+    """Return the list of patches (in "x,y" format) to process in a tract.
+
+    If `patches` is empty, all patches of the tract in the skymap are returned.
+    `patches` can also be a string in "1,1^2,2^3,3" format.
+    """
+    if not patches:
+        # Extract the patches for this tract from the skymap
+        skymap = butler.get(datasetType='deepCoadd_skyMap')
+        patches = ['%d,%d' % patch.getIndex() for patch in skymap[tract]]
+    elif hasattr(patches, 'split'):
+        patches = patches.split('^')
+
+    if not all(re.match(r'\d,\d$', p) for p in patches):
+        raise ValueError('patches should be a list or a string in "1,1^2,2^3,3" format')
+
+    return list(patches)
+
+
+def _init_worker(repo):
+    global _worker_butler  # pylint: disable=global-statement
+    _worker_butler = Butler(repo)
+
+
+def _run_unit(process_patch, output_dir, kwargs, unit):
+    tract, patch = unit
+    t0 = time.time()
+    status = process_patch(output_dir, _worker_butler, tract, patch, **kwargs)
+    return tract, patch, status, time.time() - t0
+
+
+def run_patch_units(process_patch, output_dir, repo, units, n_workers=1, verbose=False, **kwargs):
+    """Process (tract, patch) units with a pool of `n_workers` processes.
+
+    Parameters
+    --
+    process_patch : callable
+        Module-level function that processes one patch (see module docstring)
+    output_dir : str
+        Output directory
+    repo : str
+        Butler repository; each worker opens its own Butler instance
+    units : list of (int, str)
+        (tract, patch) pairs to process
+    n_workers : int
+        Number of worker processes
+    verbose : bool
+        Report progress and per-unit timings
+    **kwargs
+        Passed to `process_patch`
+
+    Returns
+    --
+    dict of {(tract, patch): (status, elapsed time in seconds)}
+    """
+    my_print = print if verbose else (lambda *x: None)
+
+    units = list(units)
+    n_units = len(units)
+    results = {}
+    t_start = time.time()
+
+    func = partial(_run_unit, process_patch, output_dir, kwargs)
+    with multiprocessing.Pool(n_workers, initializer=_init_worker, initargs=(repo,)) as pool:
+        for i, (tract, patch, status, elapsed) in enumerate(pool.imap_unordered(func, units), 1):
+            results[(tract, patch)] = (status, elapsed)
+            my_print("[{}/{}] tract {}, patch {}: {} ({:.1f} s)".format(i, n_units, tract, patch, status, elapsed))
+
+    statuses = [status for status, _ in results.values()]
+    my_print("Processed {} units in {:.1f} s with {} workers: {} written, {} empty, {} skipped".format(
+        n_units, time.time() - t_start, n_workers,
+        statuses.count("written"), statuses.count("empty"), statuses.count("skipped"),
+    ))
+    return results
@@ -5,19 +5,27 @@ Repartition a parquet file into tracts
 Author: Yao-Yuan Mao
 """
 import os
+import math
+import tempfile
 import multiprocessing as mp
+from functools import partial
 from argparse import ArgumentParser, RawTextHelpFormatter
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from tqdm import tqdm
 
 import lsst.geom
 from lsst.daf.persistence import Butler
 import desc_dc2_dm_data
 
+from patch_encoding import PATCH_DTYPE, encode_patch, decode_patch_str
+from sky_coordinates import radec_deg_to_xyz
 
-__all__ = ["get_tract_patch", "repartition_into_tracts"]
+
+__all__ = ["get_tract_patch", "TractPatchLookup", "repartition_into_tracts"]
 
 
 def get_number_of_workers(input_n_cores=None):
@@ -43,13 +51,288 @@ def get_tract_patch(skymap, ra, dec):
     return tractInfo.getId(), "{},{}".format(*patchInfo.getIndex())
 
 
-def get_tract_patch_arrays(skymap, ra_arr, dec_arr, disable_tqdm=None):
-    tract, patch = [], []
-    for ra, dec in tqdm(zip(ra_arr, dec_arr), total=len(ra_arr), disable=disable_tqdm):
-        tract_this, patch_this = get_tract_patch(skymap, ra, dec)
-        tract.append(tract_this)
-        patch.append(patch_this)
-    return tract, patch
+class TractPatchLookup():
+    """Vectorized tract/patch lookup for a given skymap.
+
+    The tract assignment follows `skymap.findTract`: for a RingsSkyMap the
+    ring/RA layout is recomputed from the skymap config, otherwise the tract with
+    the nearest center is chosen (as in BaseSkyMap). The patch assignment follows
+    `tractInfo.findPatch`, with the tract WCS (TAN or STG) evaluated in NumPy.
+    Geometry of each tract (WCS parameters, bounding box, patch dimensions)
+    is computed once, the first time a tract is seen.
+
+    Points that cannot be handled by the vectorized path (e.g., a tract WCS with
+    an unsupported projection, or a point outside the tract bounding box)
+    fall back to the per-point `get_tract_patch`, so the results are the same
+    as calling `get_tract_patch` on each point.
+
+    Parameters
+    ----------
+    skymap : lsst.skymap.BaseSkyMap
+    chunk_size : int, optional (default: 1000000)
+        Number of points to process at once when computing distances to tract centers.
+    """
+    _supported_projections = ("TAN", "STG")
+
+    def __init__(self, skymap, chunk_size=1000000):
+        self.skymap = skymap
+        self.chunk_size = int(chunk_size)
+        self._tracts = dict()
+        self._ring_nums = self._get_ring_nums(skymap)
+        if self._ring_nums is None:
+            tract_info_list = list(skymap)
+            self._tract_ids = np.array([tract_info.getId() for tract_info in tract_info_list], dtype=np.int64)
+            self._tract_centers = radec_deg_to_xyz(
+                [tract_info.getCtrCoord().getRa().asDegrees() for tract_info in tract_info_list],
+                [tract_info.getCtrCoord().getDec().asDegrees() for tract_info in tract_info_list],
+            )
+
+    @staticmethod
+    def _get_ring_nums(skymap):
+        # Same layout as in lsst.skymap.RingsSkyMap.__init__
+        num_rings = getattr(skymap.config, "numRings", None)
+        if num_rings is None:
+            return
+        ring_size = math.pi / (num_rings + 1)
+        ring_nums = []
+        for i in range(num_rings):
+            start_dec = ring_size * (i + 0.5) - 0.5 * math.pi
+            stop_dec = start_dec + ring_size
+            dec = min(math.fabs(start_dec), math.fabs(stop_dec))
+            ring_nums.append(int(2 * math.pi * math.cos(dec) / ring_size) + 1)
+        if sum(ring_nums) + 2 != len(skymap):
+            return
+        return np.array(ring_nums, dtype=np.int64)
+
+    def find_tract(self, ra, dec):
+        """Return tract ids (as an int64 array) for arrays of ra, dec (in degrees)."""
+        ra = np.asarray(ra, dtype=np.float64)
+        dec = np.asarray(dec, dtype=np.float64)
+        if self._ring_nums is not None:
+            return self._find_tract_rings(ra, dec)
+
+        tract = np.empty(len(ra), dtype=np.int64)
+        for start in range(0, len(ra), self.chunk_size):
+            s = slice(start, start + self.chunk_size)
+            xyz = radec_deg_to_xyz(ra[s], dec[s])
+            tract[s] = self._tract_ids[np.argmax(xyz @ self._tract_centers.T, axis=1)]
+        return tract
+
+    def _find_tract_rings(self, ra, dec):
+        # Vectorized version of lsst.skymap.RingsSkyMap.findTract
+        num_rings = len(self._ring_nums)
+        ring_size = math.pi / (num_rings + 1)
+        first_ring_start = ring_size * 0.5 - 0.5 * math.pi
+
+        # `int()` truncates towards zero, hence np.trunc rather than np.floor
+        ring = np.trunc((np.deg2rad(dec) - first_ring_start) / ring_size).astype(np.int64)
+        south = ring < 0
+        north = ring >= num_rings
+        ring = np.clip(ring, 0, num_rings - 1)
+
+        n_in_ring = self._ring_nums[ring]
+        delta_ra = 2 * math.pi / n_in_ring
+        ra_from_start = np.mod(np.deg2rad(ra - self.skymap.config.raStart), 2 * math.pi)
+        tract_in_ring = np.floor(ra_from_start / delta_ra + 0.5).astype(np.int64)
+        tract_in_ring[tract_in_ring == n_in_ring] = 0  # wrap around
+
+        ring_offsets = np.concatenate([[1], 1 + np.cumsum(self._ring_nums)])
+        tract = ring_offsets[ring] + tract_in_ring
+        if getattr(self.skymap, "_version", 1) == 0:
+            # Maintain the off-by-one bug in version 0 (DM-8451)
+            tract[(tract_in_ring == 0) & (ring != 0)] -= 1
+
+        tract[south] = 0
+        tract[north] = len(self.skymap) - 1
+        return tract
+
+    def _get_tract_geometry(self, tract_id):
+        if tract_id in self._tracts:
+            return self._tracts[tract_id]
+
+        tract_info = self.skymap[int(tract_id)]
+        wcs = tract_info.getWcs()
+        projection = wcs.getFitsMetadata().getScalar("CTYPE1")[-3:]
+        if projection not in self._supported_projections:
+            geometry = None
+        else:
+            sky_origin = wcs.getSkyOrigin()
+            ra0 = sky_origin.getRa().asRadians()
+            dec0 = sky_origin.getDec().asRadians()
+            pixel_origin = wcs.getPixelOrigin()
+            bbox = tract_info.getBBox()
+            geometry = dict(
+                projection=projection,
+                # unit vectors of the tangent point, and towards east and north
+                basis=np.array([
+                    [math.cos(dec0) * math.cos(ra0), math.cos(dec0) * math.sin(ra0), math.sin(dec0)],
+                    [-math.sin(ra0), math.cos(ra0), 0.0],
+                    [-math.sin(dec0) * math.cos(ra0), -math.sin(dec0) * math.sin(ra0), math.cos(dec0)],
+                ]),
+                cd_inv=np.linalg.inv(np.asarray(wcs.getCdMatrix(), dtype=np.float64)),
+                pixel_origin=np.array([pixel_origin.getX(), pixel_origin.getY()]),
+                bbox_min=np.array([bbox.getMinX(), bbox.getMinY()]),
+                bbox_max=np.array([bbox.getMaxX(), bbox.getMaxY()]),
+                patch_dims=np.array(list(tract_info.getPatchInnerDimensions())),
+                num_patches=np.array(list(tract_info.getNumPatches())),
+            )
+        self._tracts[tract_id] = geometry
+        return geometry
+
+    def _find_patch_in_tract(self, geometry, ra, dec):
+        # Vectorized version of lsst.skymap.TractInfo.findPatch
+        # Returns patch index (x, y) and a mask of points handled successfully
+        xyz = radec_deg_to_xyz(ra, dec) @ geometry["basis"].T
+        cos_dist = xyz[:, 0]
+        if geometry["projection"] == "TAN":
+            denom = cos_dist
+        else:  # STG
+            denom = 0.5 * (1.0 + cos_dist)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            intermediate = np.rad2deg(xyz[:, 1:] / denom[:, np.newaxis])
+        pixel = intermediate @ geometry["cd_inv"].T + geometry["pixel_origin"]
+
+        # lsst.geom.Point2I(Point2D) rounds to the nearest integer
+        pixel_index = np.floor(pixel + 0.5)
+        ok = (cos_dist > 0) & np.isfinite(pixel_index).all(axis=1)
+        ok &= ((pixel_index >= geometry["bbox_min"]) & (pixel_index <= geometry["bbox_max"])).all(axis=1)
+        pixel_index[~ok] = 0
+
+        patch_index = np.trunc(pixel_index / geometry["patch_dims"]).astype(np.int64)
+        ok &= ((patch_index >= 0) & (patch_index < geometry["num_patches"])).all(axis=1)
+        return patch_index, ok
+
+    def find_tract_patch(self, ra, dec):
+        """Find tract and patch for arrays of ra, dec (in degrees).
+
+        Returns
+        -------
+        tract : ndarray of int64
+        patch_x, patch_y : ndarray of int64
+            Patch index, i.e., the patch is "{patch_x},{patch_y}"
+        """
+        ra = np.asarray(ra, dtype=np.float64)
+        dec = np.asarray(dec, dtype=np.float64)
+        tract = self.find_tract(ra, dec)
+        patch_index = np.zeros((len(ra), 2), dtype=np.int64)
+        ok = np.zeros(len(ra), dtype=bool)
+
+        sorter = np.argsort(tract, kind="stable")
+        tract_ids, starts = np.unique(tract[sorter], return_index=True)
+        for tract_id, idx in zip(tract_ids, np.split(sorter, starts[1:])):
+            geometry = self._get_tract_geometry(tract_id)
+            if geometry is None:
+                continue
+            patch_index[idx], ok[idx] = self._find_patch_in_tract(geometry, ra[idx], dec[idx])
+
+        for i in np.flatnonzero(~ok):
+            tract_this, patch_this = get_tract_patch(self.skymap, ra[i], dec[i])
+            tract[i] = tract_this
+            patch_index[i] = [int(p) for p in patch_this.split(",")]
+
+        return tract, patch_index[:, 0], patch_index[:, 1]
+
+
+def get_tract_patch_arrays(skymap, ra_arr, dec_arr, disable_tqdm=None, chunk_size=1000000):
+    lookup = TractPatchLookup(skymap, chunk_size=chunk_size)
+    tract, patch = _find_tract_patch_serial(lookup, ra_arr, dec_arr, chunk_size, disable_tqdm)
+    return tract, decode_patch_str(patch)
+
+
+def _find_tract_patch_serial(lookup, ra_arr, dec_arr, chunk_size=1000000, tqdm_disable=None):
+    results = []
+    for start in tqdm(range(0, len(ra_arr), chunk_size), disable=tqdm_disable):
+        s = slice(start, start + chunk_size)
+        tract, patch_x, patch_y = lookup.find_tract_patch(ra_arr[s], dec_arr[s])
+        results.append((tract, encode_patch(patch_x, patch_y)))
+    if not results:
+        return np.array([], dtype=np.int64), np.array([], dtype=PATCH_DTYPE)
+    return tuple(np.concatenate(arrays) for arrays in zip(*results))
+
+
+# Each worker process of the pool holds its own lookup (and hence skymap),
+# which is loaded once by `_init_worker` rather than pickled for every task.
+_worker_lookup = None
+
+
+def _init_worker(repo):
+    global _worker_lookup  # pylint: disable=global-statement
+    _worker_lookup = TractPatchLookup(Butler(repo).get("deepCoadd_skyMap"))
+
+
+def _find_tract_patch_worker(args):
+    path, start, stop = args
+    radec = np.load(path, mmap_mode="r")
+    tract, patch_x, patch_y = _worker_lookup.find_tract_patch(radec[0, start:stop], radec[1, start:stop])
+    return tract.astype(np.int32), encode_patch(patch_x, patch_y)
+
+
+def _get_shared_memory_dir():
+    return "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+def _find_tract_patch_parallel(pool, ra_arr, dec_arr, n_workers, chunk_size=1000000, tqdm_disable=None):
+    n = len(ra_arr)
+    n_chunks = max(n_workers, -(-n // chunk_size))
+    bounds = np.linspace(0, n, n_chunks + 1).astype(np.int64)
+
+    # ra and dec are shared with the workers through a memory-mapped file (in /dev/shm if available);
+    # each task only carries the file path and the row range.
+    with tempfile.TemporaryDirectory(dir=_get_shared_memory_dir()) as tmp_dir:
+        path = os.path.join(tmp_dir, "radec.npy")
+        radec = np.lib.format.open_memmap(path, mode="w+", dtype=np.float64, shape=(2, n))
+        radec[0] = ra_arr
+        radec[1] = dec_arr
+        radec.flush()
+        del radec
+
+        tasks = [(path, start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+        results = list(tqdm(pool.imap(_find_tract_patch_worker, tasks), total=len(tasks), disable=tqdm_disable))
+
+    return tuple(np.concatenate(arrays) for arrays in zip(*results))
+
+
+def _repartition_one_file_streaming(
+    input_file,
+    output_root_dir,
+    find_tract_patch,
+    ra_label="ra",
+    dec_label="dec",
+    batch_size=1000000,
+    tqdm_disable=None,
+):
+    parquet_file = pq.ParquetFile(input_file)
+    schema = parquet_file.schema_arrow.remove_metadata()
+    schema = schema.append(pa.field("tract", pa.int64())).append(pa.field("patch", pa.from_numpy_dtype(PATCH_DTYPE)))
+
+    writers = dict()
+    try:
+        n_batches = -(-parquet_file.metadata.num_rows // batch_size)
+        for batch in tqdm(parquet_file.iter_batches(batch_size=batch_size), total=n_batches, disable=tqdm_disable):
+            table = pa.Table.from_batches([batch])
+            tract, patch = find_tract_patch(
+                table.column(ra_label).to_numpy(),
+                table.column(dec_label).to_numpy(),
+                tqdm_disable=True,
+            )
+            tract = tract.astype(np.int64)
+            table = table.append_column("tract", pa.array(tract)).append_column("patch", pa.array(patch))
+
+            # Group rows by tract and append each group to the writer of that tract
+            sorter = np.argsort(tract, kind="stable")
+            tract_ids, starts, counts = np.unique(tract[sorter], return_index=True, return_counts=True)
+            table = table.take(pa.array(sorter))
+            for tract_id, start, count in zip(tract_ids, starts, counts):
+                if tract_id not in writers:
+                    output_dir = os.path.join(output_root_dir, str(tract_id))
+                    os.makedirs(output_dir, exist_ok=True)
+                    output_path = os.path.join(output_dir, os.path.basename(input_file))
+                    writers[tract_id] = pq.ParquetWriter(output_path, schema)
+                writers[tract_id].write_table(table.slice(start, count))
+            del table, batch
+    finally:
+        for writer in writers.values():
+            writer.close()
 
 
 def repartition_into_tracts(
@@ -60,6 +343,8 @@ def repartition_into_tracts(
     dec_label="dec",
     n_cores=None,
     silent=False,
+    streaming=False,
+    batch_size=1000000,
     **kwargs
 ):
     """ Take a parquet catalog and split it into tracts according to a given skymap, and write to disk
@@ -71,6 +356,7 @@ def repartition_into_tracts(
     output_root_dir : str
         Path to the output directory. The output files will have the following filename
         <output_root_dir>/<tract>/<input_file_basename>
+        The `patch` column is stored as an encoded integer (see `patch_encoding.py`).
     skymap_source_repo : str
     Path or existing key if desc_dc2_dm_data.REPOS to indicate the butler repo for loading skymap
 
@@ -80,42 +366,68 @@ def repartition_into_tracts(
         Column name for RA, default to 'ra'. The unit is assumed to be degrees.
     dec_label : str, optional
         Column name for Dec, default to 'dec'. The unit is assumed to be degrees.
+    n_cores : int, optional
+        Number of worker processes. The worker pool is created once and reused for all input files.
+        Default to the number of available cores.
     silent : bool, optional (default: False)
         If true, turn off most printout.
+    streaming : bool, optional (default: False)
+        If true, read the input file one batch at a time and append each batch
+        to the output file of each tract, so that memory usage does not scale with the input file size.
+    batch_size : int, optional (default: 1000000)
+        Number of rows per batch when `streaming` is set.
     """
     my_print = (lambda *x: None) if silent else print
     tqdm_disable = silent or None
 
     repo = desc_dc2_dm_data.REPOS.get(skymap_source_repo, skymap_source_repo)
-    my_print("Obtain skymap from", repo)
-    skymap = Butler(repo).get("deepCoadd_skyMap")
-
-    for input_file in input_files:
-        my_print("Loading input parquet file", input_file)
-        df = pd.read_parquet(input_file)
-
-        # Add tract, patch columns to df (i.e., input)
-        n_cores = get_number_of_workers(n_cores)
-        my_print("Finding tract and patch for each row, using", n_cores, "cores")
-        skymap_arr = [skymap] * n_cores
-        ra_arr = np.array_split(df[ra_label].values, n_cores)
-        dec_arr = np.array_split(df[dec_label].values, n_cores)
-        tqdm_arr = [True] * n_cores
-        tqdm_arr[0] = tqdm_disable
-        with mp.Pool(n_cores) as pool:
-            tractpatch = pool.starmap(get_tract_patch_arrays, zip(skymap_arr, ra_arr, dec_arr, tqdm_arr))
-        df["tract"] = np.concatenate([tp[0] for tp in tractpatch])
-        df["patch"] = np.concatenate([tp[1] for tp in tractpatch])
-        del skymap_arr, ra_arr, dec_arr, tqdm_arr, tractpatch
-
-        my_print("Writing out parquet file for each tract in", output_root_dir)
-        for tract, df_this_tract in tqdm(df.groupby("tract"), total=df["tract"].nunique(False), disable=tqdm_disable):
-            output_dir = os.path.join(output_root_dir, str(tract))
-            os.makedirs(output_dir, exist_ok=True)
-            output_path = os.path.join(output_dir, os.path.basename(input_file))
-            df_this_tract.to_parquet(output_path, index=False)
-
-        my_print("Done with", input_file)
+    n_cores = get_number_of_workers(n_cores)
+
+    pool = None
+    if n_cores > 1:
+        my_print("Obtain skymap from", repo, "in each of the", n_cores, "worker processes")
+        pool = mp.Pool(n_cores, initializer=_init_worker, initargs=(repo,))
+        find_tract_patch = partial(_find_tract_patch_parallel, pool, n_workers=n_cores)
+    else:
+        my_print("Obtain skymap from", repo)
+        lookup = TractPatchLookup(Butler(repo).get("deepCoadd_skyMap"))
+        find_tract_patch = partial(_find_tract_patch_serial, lookup)
+
+    try:
+        for input_file in input_files:
+            if streaming:
+                my_print("Repartitioning input parquet file", input_file, "in batches of", batch_size, "rows")
+                _repartition_one_file_streaming(
+                    input_file, output_root_dir, find_tract_patch, ra_label, dec_label, batch_size, tqdm_disable
+                )
+                my_print("Done with", input_file)
+                continue
+
+            my_print("Loading input parquet file", input_file)
+            df = pd.read_parquet(input_file)
+
+            # Add tract, patch columns to df (i.e., input)
+            my_print("Finding tract and patch for each row, using", n_cores, "cores")
+            tract, patch = find_tract_patch(
+                df[ra_label].values, df[dec_label].values, tqdm_disable=tqdm_disable
+            )
+            df["tract"] = tract.astype(np.int64)
+            df["patch"] = patch
+            del tract, patch
+
+            my_print("Writing out parquet file for each tract in", output_root_dir)
+            for tract, df_this_tract in tqdm(df.groupby("tract"), total=df["tract"].nunique(False), disable=tqdm_disable):
+                output_dir = os.path.join(output_root_dir, str(tract))
+                os.makedirs(output_dir, exist_ok=True)
+                output_path = os.path.join(output_dir, os.path.basename(input_file))
+                df_this_tract.to_parquet(output_path, index=False)
+
+            my_print("Done with", input_file)
+
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
 
 def main():
@@ -138,6 +450,10 @@ Files within each tract directory can be then merged to produce a single file (u
     parser.add_argument("--skymap-source-repo", default="2.2i_dr6_wfd")
     parser.add_argument("--silent", action="store_true")
     parser.add_argument("--n-cores", "--cores", dest="n_cores", type=int)
+    parser.add_argument("--streaming", action="store_true",
+                        help="Read input files in batches to keep memory usage bounded")
+    parser.add_argument("--batch-size", type=int, default=1000000,
+                        help="Number of rows per batch when --streaming is set (default: %(default)s)")
 
     repartition_into_tracts(**vars(parser.parse_args()))
 
@@ -0,0 +1,24 @@
+"""
+sky_coordinates.py
+
+Conversion of sky coordinates to unit vectors,
+shared by the scripts that match or partition positions on the sphere.
+The unit of RA, Dec is explicit in the function names.
+"""
+import numpy as np
+
+__all__ = ["radec_rad_to_xyz", "radec_deg_to_xyz"]
+
+
+def radec_rad_to_xyz(ra, dec):
+    """Convert RA, Dec [rad] to unit vectors (shape (..., 3))."""
+    ra = np.asarray(ra, dtype=np.float64)
+    dec = np.asarray(dec, dtype=np.float64)
+    cos_dec = np.cos(dec)
+    return np.stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)], axis=-1)
+
+
+def radec_deg_to_xyz(ra, dec):
+    """Convert RA, Dec [deg] to unit vectors (shape (..., 3))."""
+    return radec_rad_to_xyz(np.deg2rad(np.asarray(ra, dtype=np.float64)),
+                            np.deg2rad(np.asarray(dec, dtype=np.float64)))